@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, datetime
+from remove_old_backups import *
+
+
+def create_backups(directory, count):
+    '''
+    Create empty backup files with unique dates in the given directory.
+    '''
+    files = []
+    for day in range(count):
+        file = "bench_backup_{}_{:02d}_{:02d}_{:04d}.tar".format(day, day % 12 + 1, day % 28 + 1, 2000 + day // 336)
+        open(os.path.join(directory, file), "w").close()
+        files.append(file)
+    return files
+
+
+def time_local_delete(directory, count, jobs):
+    '''
+    Time how long delete_old_backups takes to remove the given number of backups from
+    the local directory using the requested number of worker threads.
+    '''
+    work_dir = tempfile.mkdtemp(dir=directory)
+    try:
+        files = create_backups(work_dir, count)
+        start = time.perf_counter()
+        delete_old_backups(files, set(), "benchmark", local_dir=work_dir + "/", jobs=jobs)
+        return time.perf_counter() - start
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def compare_local_delete(directory, count, jobs):
+    '''
+    Compare the throughput of the serial local delete loop with the thread pool.
+    '''
+    print("Removing {} backups from {}".format(count, directory))
+    for workers in (1,) + tuple(jobs):
+        elapsed = time_local_delete(directory, count, workers)
+        print("jobs={:<4} {:8.3f}s {:12.0f} backups/s".format(workers, elapsed, count / elapsed))
+
+
+def probe_latency(directory, stop, latencies):
+    '''
+    Write and fsync a small block over and over, as a database sharing the volume would,
+    recording how long each write takes until stop is set.
+    '''
+    block = os.urandom(4096)
+    with open(os.path.join(directory, "probe"), "wb", buffering=0) as probe:
+        while not stop.is_set():
+            start = time.perf_counter()
+            probe.seek(0)
+            probe.write(block)
+            os.fsync(probe.fileno())
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.005)
+
+
+def time_large_delete(directory, size, rate, settle=2.0):
+    '''
+    Remove one allocated file of the given size, with os.remove when rate is 0 or with
+    remove_throttled otherwise, while probe_latency writes to the same volume. Probing
+    carries on for settle seconds after the removal, as the filesystem may free the
+    extents after the unlink has returned. Returns the time taken to remove the file
+    and the latency of every probe write.
+    '''
+    work_dir = tempfile.mkdtemp(dir=directory)
+    try:
+        path = os.path.join(work_dir, "large_backup_01_01_2024.tar")
+        with open(path, "wb") as backup:
+            os.posix_fallocate(backup.fileno(), 0, size)
+        os.sync()
+
+        stop = threading.Event()
+        latencies = []
+        probe = threading.Thread(target=probe_latency, args=(work_dir, stop, latencies))
+        probe.start()
+        start = time.perf_counter()
+        if rate:
+            remove_throttled(path, rate, min_size=0)
+        else:
+            os.remove(path)
+        elapsed = time.perf_counter() - start
+        time.sleep(settle)
+        stop.set()
+        probe.join()
+        return elapsed, latencies
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def compare_large_delete(directory, size, rates):
+    '''
+    Compare the latency seen by concurrent writes while a large backup is removed at
+    once and while it is shrunk at each of the given rates first.
+    '''
+    print("Removing a {} byte backup from {} while writing to the same volume".format(size, directory))
+    print("{:<12} {:>9} {:>9} {:>9} {:>9} {:>9}".format("rate", "remove s", "writes", "p50 ms", "p99 ms", "max ms"))
+    for rate in rates:
+        elapsed, latencies = time_large_delete(directory, size, parse_size(rate))
+        latencies.sort()
+        print("{:<12} {:>9.2f} {:>9} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            rate if parse_size(rate) else "unlink", elapsed, len(latencies),
+            1000 * latencies[len(latencies) // 2], 1000 * latencies[int(len(latencies) * 0.99)], 1000 * latencies[-1]))
+
+
+def strptime_backup_date(file):
+    '''
+    The original per-file date parser, kept as a reference for the date benchmark.
+    '''
+    date = re.search(r"\d{2}_\d{2}_\d{4}", file)
+    date_index = date.span()
+    return datetime.strptime(file[date_index[0]:date_index[1]], "%m_%d_%Y")
+
+
+def compare_date_parsing(count):
+    '''
+    Compare the time taken to parse the date of each backup in a nightly listing using
+    datetime.strptime and using parse_backup_date, with only the default date format
+    enabled and with every registered format enabled.
+    '''
+    files = ["bench_backup_{:02d}_{:02d}_{:04d}.tar".format(day % 12 + 1, day % 28 + 1, 2000 + day // 336) for day in range(count)]
+    print("Parsing the dates of {} backups".format(count))
+    for name, parser, formats in (("strptime", strptime_backup_date, ("mdy",)), ("parse_backup_date", parse_backup_date, ("mdy",)), ("all formats", parse_backup_date, tuple(date_formats))):
+        use_date_formats(formats)
+        start = time.perf_counter()
+        for file in files:
+            parser(file)
+        elapsed = time.perf_counter() - start
+        print("{:<18} {:8.3f}s {:12.0f} backups/s".format(name, elapsed, count / elapsed))
+    use_date_formats(("mdy",))
+
+
+def synthetic_listing(count, copies_per_date=1):
+    '''
+    Generate count backup filenames with copies_per_date backups sharing each date.
+    Dates wrap around after about 5000 years so any count can be generated.
+    '''
+    start = date(1900, 1, 1).toordinal()
+    span = min(count // copies_per_date + 1, 2000000)
+    dates = ["{0.month:02d}_{0.day:02d}_{0.year:04d}".format(date.fromordinal(start + day)) for day in range(span)]
+    for index in range(count):
+        yield "bench_backup_{}_{}.tar".format(index, dates[(index // copies_per_date) % span])
+
+
+def run_pipeline(scenario, count, work_dir, connection):
+    '''
+    Prepare a synthetic backup set, prune it from find_backups through delete_old_backups
+    and send the per-stage metrics and the peak RSS back to the parent. This runs in its
+    own process so that the peak RSS belongs to this run alone.
+
+    local       backups are files in a local directory, scanned and removed with os.remove
+    remote      backups are listed by a fake list command and passed to a fake delete
+                command on stdin, as a remote backend would be with -b stdin
+    duplicates  like remote, with 10 backups sharing each date
+    '''
+    backup_dir = os.path.join(work_dir, "{}_{}".format(scenario, count))
+    os.makedirs(backup_dir)
+
+    if scenario == "local":
+        for file in synthetic_listing(count):
+            open(os.path.join(backup_dir, file), "w").close()
+        settings = {"backup_list_command": False, "local_dir": backup_dir + "/"}
+    else:
+        listing = os.path.join(backup_dir, "listing.txt")
+        with open(listing, "w") as listing_file:
+            for file in synthetic_listing(count, 10 if scenario == "duplicates" else 1):
+                listing_file.write(file + "\n")
+        settings = {"backup_list_command": "cat {}".format(listing), "delete_command": "cat > /dev/null", "batch_mode": "stdin"}
+
+    metrics = {"stages": {}}
+    start = time.perf_counter()
+    prune_backups(backup_name="benchmark", copies_to_keep=4, metrics=metrics, **settings)
+    metrics["seconds"] = time.perf_counter() - start
+    metrics["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    connection.send(metrics)
+    connection.close()
+
+
+def benchmark_pipeline(directory, scenarios, sizes):
+    '''
+    Time each stage of the prune pipeline for every scenario and listing size. Returns
+    one result per run with the stage timings, throughput and peak RSS.
+    '''
+    context = multiprocessing.get_context("fork")
+    results = []
+    print("{:<11} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>12} {:>9}".format("scenario", "backups", "find", "dates", "identify", "delete", "total", "backups/s", "rss MB"))
+    for scenario in scenarios:
+        for count in sizes:
+            work_dir = tempfile.mkdtemp(dir=directory)
+            try:
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(target=run_pipeline, args=(scenario, count, work_dir, sender))
+                process.start()
+                sender.close()
+                metrics = receiver.recv()
+                process.join()
+            finally:
+                shutil.rmtree(work_dir)
+
+            stages = metrics["stages"]
+            result = {
+                "scenario": scenario,
+                "backups": count,
+                "stages": {stage: counts["seconds"] for stage, counts in stages.items()},
+                "seconds": metrics["seconds"],
+                "backups_per_second": count / metrics["seconds"],
+                "peak_rss_mb": metrics["peak_rss_kb"] / 1024,
+            }
+            results.append(result)
+            print("{:<11} {:>9} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>12.0f} {:>9.1f}".format(
+                scenario, count, *(result["stages"].get(stage, 0) for stage in ("find_backups", "extract_date", "identify_old_backups", "delete_old_backups")),
+                result["seconds"], result["backups_per_second"], result["peak_rss_mb"]))
+
+    return results
+
+
+def save_results(results, results_file):
+    '''
+    Save benchmark results with enough context to compare them between versions.
+    '''
+    with open(results_file, "w") as output:
+        json.dump({"python": platform.python_version(), "platform": platform.platform(), "created": time.time(), "results": results}, output, indent=2)
+
+
+def compare_results(results, baseline_file):
+    '''
+    Print how the time and peak RSS of each run changed against saved results.
+    '''
+    with open(baseline_file) as baseline:
+        baseline = {(result["scenario"], result["backups"]): result for result in json.load(baseline)["results"]}
+
+    print("Compared with {}".format(baseline_file))
+    for result in results:
+        previous = baseline.get((result["scenario"], result["backups"]))
+        if previous:
+            print("{:<11} {:>9} time {:+7.1f}% rss {:+7.1f}%".format(
+                result["scenario"], result["backups"],
+                100 * (result["seconds"] / previous["seconds"] - 1),
+                100 * (result["peak_rss_mb"] / previous["peak_rss_mb"] - 1)))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.CRITICAL)
+
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument("benchmark", help="Benchmark to run.", choices=("all", "delete", "dates", "pipeline", "truncate"), nargs="?", default="all")
+    parser.add_argument('-d', dest='directory', help='Directory to create the benchmark backups in. Use a network mount to measure unlink latency.', default=tempfile.gettempdir())
+    parser.add_argument('-N', dest='count', help='Number of backups to remove per run.', type=int, default=5000)
+    parser.add_argument('-j', dest='jobs', help='Worker thread counts to compare against the serial loop.', type=int, nargs='+', default=[4, 16])
+    parser.add_argument('-s', dest='sizes', help='Listing sizes for the pipeline benchmark.', type=int, nargs='+', default=[10 ** 3, 10 ** 4, 10 ** 5])
+    parser.add_argument('--scenarios', dest='scenarios', help='Pipeline scenarios to run.', choices=("local", "remote", "duplicates"), nargs='+', default=["local", "remote", "duplicates"])
+    parser.add_argument('-S', dest='large_size', help='Size of the backup removed by the truncate benchmark, e.g. 10G.', default="1G")
+    parser.add_argument('--rates', dest='rates', help='Delete rates to compare in the truncate benchmark. 0 removes the backup at once.', nargs='+', default=["0", "256M", "1G"])
+    parser.add_argument('-o', dest='results_file', help='File to save the pipeline results to.', default=False)
+    parser.add_argument('--compare', dest='baseline_file', help='Pipeline results saved by an earlier version to compare against.', default=False)
+    args = parser.parse_args()
+
+    if args.benchmark in ("all", "delete"):
+        compare_local_delete(args.directory, args.count, args.jobs)
+    if args.benchmark in ("all", "dates"):
+        compare_date_parsing(args.count * 100)
+    if args.benchmark in ("all", "pipeline"):
+        results = benchmark_pipeline(args.directory, args.scenarios, args.sizes)
+        if args.results_file:
+            save_results(results, args.results_file)
+        if args.baseline_file:
+            compare_results(results, args.baseline_file)
+    if args.benchmark == "truncate":
+        compare_large_delete(args.directory, parse_size(args.large_size), args.rates)
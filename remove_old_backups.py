@@ -1,13 +1,127 @@
 #!/usr/bin/python3
 
-from datetime import datetime
+from datetime import date
 import subprocess
 import shlex
 import sys
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import re
 import os
 import argparse
+import heapq
+import tempfile
+import json
+import sqlite3
+import multiprocessing
+import multiprocessing.connection
+import signal
+import time
+import queue
+import atexit
+import ctypes
+import ctypes.util
+import select
+import struct
+import mmap
+import csv
+import asyncio
+import random
+import stat
+import functools
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import closing, contextmanager
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+# Level used for the line logged for every backup removed. It sits between DEBUG and INFO
+# so the summary log level can leave these lines out while keeping every failure.
+BACKUP = 15
+logging.addLevelName(BACKUP, "BACKUP")
+
+# Everything is logged through this logger, which passes records on to the handlers
+# set up by configure_logging. When the module is imported and logging hasn't been
+# configured, nothing is written.
+logger = logging.getLogger("remove_old_backups")
+logger.addHandler(logging.NullHandler())
+
+# Background thread writing log records when queued logging is used.
+log_listener = None
+
+
+class RetentionError(Exception):
+    '''
+    Base class of the errors raised by the importable API.
+    '''
+
+
+class InvalidBackupDate(RetentionError):
+    '''
+    A backup filename doesn't have a properly formatted date.
+    '''
+
+
+class MissingBackups(RetentionError):
+    '''
+    One or more backups to delete weren't found, which points to a problem with the
+    backup directory or the delete command. The backups handled before the error was
+    raised are given in removed and failed.
+    '''
+    def __init__(self, message, removed=(), failed=()):
+        super().__init__(message)
+        self.removed = list(removed)
+        self.failed = list(failed)
+
+
+def log_backup(message, file):
+    '''
+    Log a line about a single backup. The message is only formatted if it will be logged.
+    '''
+    if logger.isEnabledFor(BACKUP):
+        logger.log(BACKUP, message.format(file))
+
+
+def configure_logging(log_file, queued=False, summary=False):
+    '''
+    Log to the given file. With queued logging, records are put on a queue and written
+    to the file by a background thread so that slow disks don't hold up deletions. With
+    the summary level, the line for each removed backup is left out and only the counts
+    and failures are logged.
+    '''
+    global log_listener
+
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(message)s"))
+    level = logging.INFO if summary else logging.DEBUG
+
+    if queued:
+        log_queue = queue.SimpleQueue()
+        log_listener = QueueListener(log_queue, file_handler)
+        log_listener.start()
+        atexit.register(log_listener.stop)
+        # The file handler adds the time and level when the record is written.
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.setFormatter(logging.Formatter("%(message)s"))
+        logging.basicConfig(handlers=[queue_handler], level=level)
+    else:
+        logging.basicConfig(handlers=[file_handler], level=level)
+
+
+def log_directly():
+    '''
+    Write log records straight to the listener's handlers. A forked worker doesn't have
+    the listener thread, so records put on its copy of the queue would never be written.
+    '''
+    if log_listener is not None:
+        for handler in logging.root.handlers[:]:
+            logging.root.removeHandler(handler)
+        for handler in log_listener.handlers:
+            logging.root.addHandler(handler)
+
 
 def validate_backup_retention(rel_files, copies_to_keep):
     '''
@@ -18,203 +132,2138 @@ def validate_backup_retention(rel_files, copies_to_keep):
         return True
 
     else:
-        logging.info("Number of backups isn't above the minimum retention level of {}.".format(copies_to_keep))
+        logger.info("Number of backups isn't above the minimum retention level of {}.".format(copies_to_keep))
         return False
 
 
-def extract_date(rel_files, copies_to_keep=4):
+# Date formats that can be recognised in backup filenames, by name. Each pattern names
+# the year, month and day it captures, or the seconds since the epoch. The enabled
+# formats are compiled into a single alternation by use_date_formats, so each filename
+# is searched once however many formats are enabled.
+date_formats = {
+    "mdy": r"(?P<month>\d{2})_(?P<day>\d{2})_(?P<year>\d{4})",
+    "iso": r"(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})",
+    "ymd": r"(?<!\d)(?P<year>\d{4})(?P<month>\d{2})(?P<day>\d{2})(?!\d)",
+    "epoch": r"(?<!\d)(?P<epoch>\d{10})(?!\d)",
+}
+epoch_ordinal = date(1970, 1, 1).toordinal()
+
+
+def register_date_format(name, pattern):
     '''
-    Attempt to extract the date of the backup from the filename using a regular 
-    expression. If a properly formatted date isn't found in one or more filenames,
-    log an error and exit.
+    Add a date format to the registry so it can be enabled with use_date_formats. The
+    pattern must capture the year, month and day in named groups, or the epoch seconds.
+    '''
+    groups = set(re.compile(pattern).groupindex)
+    if not {"year", "month", "day"} <= groups and "epoch" not in groups:
+        raise ValueError("Date format {} must capture year, month and day or epoch".format(name))
+    date_formats[name] = pattern
+
+
+def compile_date_formats(names):
+    '''
+    Compile the named date formats into one regular expression. Each format becomes an
+    alternative wrapped in a group named after it, with its own groups prefixed by the
+    name, so the format that matched is given by match.lastgroup. Where formats could
+    match at the same position, the earlier name wins. Returns the pattern and the
+    groups holding each format's fields.
+    '''
+    alternatives = []
+    fields = {}
+    for name in names:
+        pattern = date_formats[name]
+        format_fields = ("epoch",) if "(?P<epoch>" in pattern else ("year", "month", "day")
+        for field in format_fields:
+            pattern = pattern.replace("(?P<{}>".format(field), "(?P<{}_{}>".format(name, field))
+        alternatives.append("(?P<{}>{})".format(name, pattern))
+        fields[name] = tuple("{}_{}".format(name, field) for field in format_fields)
+
+    return re.compile("|".join(alternatives)), fields
+
+
+def use_date_formats(names):
+    '''
+    Enable the named date formats for backup_date, compiled by compile_date_formats.
+    '''
+    global date_re, date_fields
+    date_re, date_fields = compile_date_formats(names)
+
+
+def calendar_ordinal(year, month, day):
+    '''
+    Convert the year, month and day read from a filename to a date ordinal.
+    '''
+    return date(int(year), int(month), int(day)).toordinal()
+
+
+# The date pattern compiled from the enabled formats and the groups holding each
+# format's fields. Nightly backups share a small number of distinct dates, so the
+# ordinals of the most recent dates are cached, up to a fixed number so that a
+# long-running process doesn't grow without bound.
+date_cache_size = 4096
+date_re = None
+date_fields = {}
+date_ordinal = functools.lru_cache(maxsize=date_cache_size)(calendar_ordinal)
+use_date_formats(("mdy",))
+
+
+def match_backup_date(file, pattern, fields, ordinal=date_ordinal):
+    '''
+    Find the date in a backup filename with a pattern and fields compiled by
+    compile_date_formats, and convert it with ordinal, as backup_date does.
+    '''
+    match = pattern.search(file)
+    if match is None:
+        raise InvalidBackupDate("Missing properly formatted date in {}".format(file))
+
+    groups = fields[match.lastgroup]
+    if len(groups) == 1:
+        # Epoch seconds are rarely shared between backups, so they aren't cached.
+        return epoch_ordinal + int(match.group(groups[0])) // 86400
+
+    try:
+        return ordinal(*match.group(*groups))
+    except ValueError as e:
+        raise InvalidBackupDate("Improperly formatted date for {} {}".format(file, e))
+
+
+def backup_date(file):
+    '''
+    Find the date in a single backup filename and convert it to a proleptic Gregorian
+    ordinal (an integer that orders the same way as the date). The fields are read from
+    the named groups of whichever enabled format matched rather than with strptime. A
+    time of day, such as in 2024-05-01T0300, isn't part of the date. Epoch seconds are
+    taken as UTC. Raises InvalidBackupDate if a properly formatted date isn't found.
+    '''
+    return match_backup_date(file, date_re, date_fields)
+
+
+def parse_backup_date(file, skip_invalid=False):
     '''
+    Return the date ordinal of a backup as backup_date does. If a properly formatted
+    date isn't found, log an error and exit, or with skip_invalid return None and leave
+    the caller to log how many backups were skipped with log_skipped.
+    '''
+    try:
+        return backup_date(file)
+
+    except InvalidBackupDate as e:
+        if skip_invalid:
+            return None
+        logger.error(e)
+        exit(1)
+
+
+# Number of skipped backups named in the log, so that a listing full of files without
+# a date doesn't add a line for each of them.
+skipped_examples = 3
+
+
+def log_skipped(skipped, examples):
+    '''
+    Log how many backups were skipped for not having a properly formatted date, naming
+    the first few at DEBUG.
+    '''
+    if skipped:
+        logger.warning("Skipped {} backups without a properly formatted date".format(skipped))
+        for file in examples[:skipped_examples]:
+            logger.debug("Skipped {}: missing properly formatted date".format(file))
 
-    # Parse the dates in the file names and convert them to datetime objects.
+
+def group_by_date(rel_files, parse_date, known_dates=None):
+    '''
+    Parse the dates in the file names with parse_date, which returns a date ordinal or
+    None to leave the backup out, and group the backups under their dates. Returns the
+    date of every backup grouped, the backups of each date and the number left out.
+    '''
     file_and_date = {}
     dates = []
-    date_format = "%m_%d_%Y"
-    date_re = r"\d{2}_\d{2}_\d{4}"
+    skipped = 0
 
-    logging.info("Identifying date of each backup using filename.")
     for file in rel_files:
-    
-        # Attempt to find the date in the filename
-        date = re.search(date_re, file)
-        try:
-            
-            date_index = date.span()
-            date = file[date_index[0]:date_index[1]]
+        ordinal = known_dates.get(file) if known_dates else None
+        if ordinal is None:
+            ordinal = parse_date(file)
+            if ordinal is None:
+                skipped += 1
+                continue
+        if ordinal in file_and_date:
+            file_and_date[ordinal].append(file)
+        else:
+            file_and_date[ordinal] = [file]
+        dates.append(ordinal)
 
-            try:
-                # Convert the date to a datetime object
-                datetime_version = datetime.strptime(date, date_format)
-                file_and_date[datetime_version] = file
-                dates.append(datetime_version)
-            
-            except ValueError as e:
-                logging.error("Improperly formatted date for {} {}".format(file, e))
-                exit(1)
+    return dates, file_and_date, skipped
 
-        except AttributeError:
-            logging.error("Missing properly formatted date in {}".format(file))
-            exit(1)
-    
-    logging.info("Identified {} dates / {} backups".format(len(dates), len(rel_files)))
+
+def extract_date(rel_files, copies_to_keep=4, known_dates=None, skip_invalid=False, counts=None):
+    '''
+    Attempt to extract the date of the backup from the filename using a regular 
+    expression. If a properly formatted date isn't found in one or more filenames,
+    log an error and exit, or with skip_invalid leave those backups out and log how
+    many were skipped. Backups that share a date are grouped together under that
+    date rather than replacing one another. Dates already parsed, such as those stored
+    in the backup index, can be passed in known_dates to skip parsing those backups.
+    The number of backups skipped is stored in counts, if given.
+    '''
+    examples = []
+
+    def parse_date(file):
+        ordinal = parse_backup_date(file, skip_invalid)
+        if ordinal is None and len(examples) < skipped_examples:
+            examples.append(file)
+        return ordinal
+
+    logger.info("Identifying date of each backup using filename.")
+    dates, file_and_date, skipped = group_by_date(rel_files, parse_date, known_dates)
+
+    log_skipped(skipped, examples)
+    if counts is not None:
+        counts["skipped"] = skipped
+    logger.info("Identified {} dates / {} backups".format(len(file_and_date), len(dates)))
     
-    # Order the dates with the most recent stored first.
+    # The most recent dates are selected later by identify_old_backups, so the dates
+    # don't need to be sorted here.
     meeting_retention_policy = validate_backup_retention(dates, copies_to_keep)
     if meeting_retention_policy:
-        dates.sort(reverse=True)
         return dates, file_and_date
     else:
         return False, False
 
 
+def plan_retention(file_and_date, copies_to_keep):
+    '''
+    Split the backups into the sets to keep and to delete. The newest copies_to_keep
+    dates are selected with a heap in O(n log k) instead of sorting every date, and
+    every backup from a selected date is kept. Both sets give O(1) membership checks.
+    '''
+    files_to_keep = set()
+    files_to_delete = set()
+
+    newest = heapq.nlargest(copies_to_keep, file_and_date)
+    if not newest:
+        return files_to_keep, files_to_delete
+
+    # The selected dates are exactly the dates at or after the oldest one selected.
+    oldest_kept = newest[-1]
+    for ordinal, files in file_and_date.items():
+        if ordinal >= oldest_kept:
+            files_to_keep.update(files)
+        else:
+            files_to_delete.update(files)
+
+    return files_to_keep, files_to_delete
+
+
+def gfs_buckets(ordinal):
+    '''
+    Return the daily, weekly, monthly and yearly bucket a backup date belongs to. Weeks
+    are ISO weeks, so a week that spans a new year belongs to a single bucket.
+    '''
+    backup_date = date.fromordinal(ordinal)
+    iso_year, iso_week, iso_weekday = backup_date.isocalendar()
+    return {
+        "daily": ordinal,
+        "weekly": (iso_year, iso_week),
+        "monthly": (backup_date.year, backup_date.month),
+        "yearly": backup_date.year,
+    }
+
+
+# Tiers of a grandfather-father-son policy, in the order of the buckets above.
+gfs_tiers = ("daily", "weekly", "monthly", "yearly")
+
+
+def check_gfs_policy(gfs_policy):
+    '''
+    Verify a grandfather-father-son policy only names known tiers, each with a whole
+    number of buckets to keep. Raises ValueError otherwise.
+    '''
+    if not isinstance(gfs_policy, dict):
+        raise ValueError("expected a table of tiers, got {!r}".format(gfs_policy))
+    for tier, count in gfs_policy.items():
+        if tier not in gfs_tiers:
+            raise ValueError("unknown tier {!r}, expected one of {}".format(tier, ", ".join(gfs_tiers)))
+        if not isinstance(count, int) or isinstance(count, bool) or count < 0:
+            raise ValueError("{} must be a whole number of at least 0, got {!r}".format(tier, count))
+
+
+def retention_reasons(file_and_date, copies_to_keep, gfs_policy=None):
+    '''
+    Return the dates to keep, each with the reason it is kept: "newest" for the newest
+    copies_to_keep dates, or the grandfather-father-son tier that selected it. gfs_policy
+    maps "daily", "weekly", "monthly" and "yearly" to the number of buckets of that kind
+    to keep. Every date is assigned to its buckets in one pass, keeping the newest date
+    in each bucket, and the newest buckets of each kind are then selected.
+    '''
+    dates_to_keep = dict.fromkeys(heapq.nlargest(copies_to_keep, file_and_date), "newest")
+    if not gfs_policy:
+        return dates_to_keep
+
+    newest_in_bucket = {tier: {} for tier in gfs_policy}
+    for ordinal in file_and_date:
+        buckets = gfs_buckets(ordinal)
+        for tier, newest in newest_in_bucket.items():
+            bucket = buckets[tier]
+            if newest.get(bucket, ordinal) <= ordinal:
+                newest[bucket] = ordinal
+
+    for tier, newest in newest_in_bucket.items():
+        for bucket in heapq.nlargest(gfs_policy[tier], newest):
+            dates_to_keep.setdefault(newest[bucket], tier)
 
-def identify_old_backups(dates, file_and_date, copies_to_keep):
+    return dates_to_keep
+
+
+def plan_gfs_retention(file_and_date, copies_to_keep, gfs_policy):
+    '''
+    Split the backups into the sets to keep and to delete using a grandfather-father-son
+    policy, keeping every date selected by retention_reasons. The newest copies_to_keep
+    dates are always kept, so the minimum retention still applies. Backups sharing a
+    selected date are all kept.
+    '''
+    dates_to_keep = retention_reasons(file_and_date, copies_to_keep, gfs_policy)
+
+    files_to_keep = set()
+    files_to_delete = set()
+    for ordinal, files in file_and_date.items():
+        if ordinal in dates_to_keep:
+            files_to_keep.update(files)
+        else:
+            files_to_delete.update(files)
+
+    return files_to_keep, files_to_delete
+
+
+def identify_old_backups(dates, file_and_date, copies_to_keep, gfs_policy=None):
     '''
     Identify the most recent backup files to retain. The number of backups to retain is 
-    determined by the value stored in the copies to keep variable.
-    '''
-    files_to_keep = []
-    index = 0
-    logging.info("Identifying most recent {} backups to keep.".format(copies_to_keep))
-    while copies_to_keep > 0:
-        key = dates[index]
-        file = file_and_date[key]
-        files_to_keep.append(file)
-        index += 1
-        copies_to_keep -= 1
-
-    logging.info("Backups to keep: {}".format(files_to_keep))
+    determined by the value stored in the copies to keep variable. Backups sharing a
+    date with a retained backup are retained as well. If a grandfather-father-son policy
+    is given, the backups it selects are retained in addition to the most recent ones.
+    '''
+    if gfs_policy:
+        logger.info("Identifying most recent {} backups and {} to keep.".format(copies_to_keep, gfs_policy))
+        files_to_keep, files_to_delete = plan_gfs_retention(file_and_date, copies_to_keep, gfs_policy)
+    else:
+        logger.info("Identifying most recent {} backups to keep.".format(copies_to_keep))
+        files_to_keep, files_to_delete = plan_retention(file_and_date, copies_to_keep)
+
+    logger.info("Backups to keep: {}".format(sorted(files_to_keep)))
     return files_to_keep
 
 
+def stream_backups(command):
+    '''
+    Run the list command and yield the backup filenames one line at a time as they are
+    read from its output, so the full listing is never held in memory. Blank lines are
+    skipped. Once the output ends, a non-zero exit status from the command is logged and
+    raised as a CalledProcessError.
+    '''
+    logger.info("Finding backups using command: {}.".format(command))
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=errors)
+        try:
+            for line in process.stdout:
+                file = line.decode("UTF-8").rstrip("\n")
+                if file:
+                    yield file
+
+        finally:
+            process.stdout.close()
+            # Stop the command if the caller stopped reading before the listing ended.
+            if process.poll() is None:
+                process.kill()
+            returncode = process.wait()
+
+        if returncode != 0:
+            errors.seek(0)
+            message = errors.read().decode("UTF-8", errors="replace").strip()
+            logger.error("The list command exited with status {}: {}".format(returncode, message))
+            raise subprocess.CalledProcessError(returncode, command)
+
+
 def find_backups(command):
     # Find backups using the specified command
-    logging.info("Finding backups using command: {}.".format(command))
-    rel_files = subprocess.run(command, shell=True, capture_output=True)
-
-    # Parse the command output and identify the filenames.
-    command_output = rel_files.stdout
-    command_output = command_output.decode("UTF-8")
-    # print(command_output)
-    rel_files = command_output.split("\n")
-    
-    # Remove the extra line from the list of relevant files.
-    del rel_files[-1]
+    try:
+        rel_files = list(stream_backups(command))
+
+    except subprocess.CalledProcessError:
+        logger.warning("No backups found")
+        return False
 
     if len(rel_files) > 0:
-        logging.info("Found {} backups.".format(len(rel_files)))
+        logger.info("Found {} backups.".format(len(rel_files)))
 
         return rel_files
     
     else:
-        logging.warning("No backups found")
+        logger.warning("No backups found")
         return False
 
 
-def delete_old_backups(rel_files, files_to_keep, backup_name, local_dir=False, delete_command=False, dry_run=False):
-# Delete any backup files that are not the recent backup files selected for retention.
-    if dry_run:
-        print("This is a dry run. Not removing any backups.")
-        logging.info("This is a dry run. Not removing any backups.")
-        for file in rel_files:
-            if file not in files_to_keep:
-                print("Backup to be removed: {}".format(file))
-                logging.info("Backup to be removed: {}".format(file))
-        
+def add_to_window(newest, file_and_date, file, ordinal, copies_to_keep):
+    '''
+    Add a backup to a retention window holding the newest copies_to_keep dates. newest
+    is a min-heap of those dates and file_and_date holds the backups for each of them.
+    Returns the backups that fell out of the window, which may include the new backup.
+    '''
+    if ordinal in file_and_date:
+        file_and_date[ordinal].append(file)
+        return []
+
+    if len(newest) < copies_to_keep:
+        heapq.heappush(newest, ordinal)
+        file_and_date[ordinal] = [file]
+        return []
+
+    if ordinal > newest[0]:
+        old_backups = file_and_date.pop(heapq.heappushpop(newest, ordinal))
+        file_and_date[ordinal] = [file]
+        return old_backups
+
+    return [file]
+
+
+def remove_from_window(newest, file_and_date, file, ordinal):
+    '''
+    Remove a backup that no longer exists from a retention window.
+    '''
+    files = file_and_date.get(ordinal)
+    if files is None or file not in files:
+        return
+
+    files.remove(file)
+    if not files:
+        del file_and_date[ordinal]
+        newest.remove(ordinal)
+        heapq.heapify(newest)
+
+
+def stream_old_backups(command, copies_to_keep, skip_invalid=False, counts=None):
+    '''
+    Read the listing from the list command and yield each backup as soon as it is known
+    to be older than the newest copies to keep, as window_old_backups does.
+    '''
+    return window_old_backups(stream_backups(command), copies_to_keep, skip_invalid, counts)
+
+
+def window_old_backups(rel_files, copies_to_keep, skip_invalid=False, counts=None):
+    '''
+    Yield each backup from an iterable listing as soon as it is known to be older than
+    the newest copies to keep. Only the backups from the newest dates seen so far are
+    held in memory, so memory use is bounded by the retention window rather than by the
+    size of the listing. A backup is only yielded once copies_to_keep newer dates have
+    been seen, so it is safe to delete it before the listing has ended. With
+    skip_invalid, backups without a properly formatted date are kept and counted. Once
+    the listing has ended, the number of backups listed, skipped and of dates kept are
+    stored in counts, if given.
+    '''
+    # The newest dates seen so far in a min-heap, and the backups listed for each of them.
+    newest = []
+    file_and_date = {}
+    skipped = 0
+    examples = []
+    listed = 0
+    for file in rel_files:
+        listed += 1
+        ordinal = parse_backup_date(file, skip_invalid)
+        if ordinal is None:
+            skipped += 1
+            if len(examples) < skipped_examples:
+                examples.append(file)
+            continue
+        yield from add_to_window(newest, file_and_date, file, ordinal, copies_to_keep)
+
+    log_skipped(skipped, examples)
+
+    if counts is not None:
+        counts["listed"] = listed
+        counts["skipped"] = skipped
+        counts["dates"] = len(newest)
+
+    files_to_keep = [file for ordinal in sorted(file_and_date, reverse=True) for file in file_and_date[ordinal]]
+    logger.info("Backups to keep: {}".format(files_to_keep))
+    if len(newest) < copies_to_keep:
+        logger.info("Number of backups isn't above the minimum retention level of {}.".format(copies_to_keep))
+
+
+def read_list_file(list_file, column=None):
+    '''
+    Yield the backups listed in an inventory file, one per line, or with a column number
+    the field in that column of each row of a CSV inventory. The file is memory mapped
+    and read a line at a time rather than read into one string and split, so only the
+    line being read is copied and a multi-gigabyte inventory never has to fit in memory.
+    Names that aren't valid UTF-8 are kept byte for byte with surrogate escapes, the
+    same way os.listdir returns them. If the inventory can't be read, or its first row
+    doesn't have the column, an error is logged and the program exits.
+    '''
+    try:
+        inventory = open(list_file, "rb")
+    except OSError as e:
+        logger.error("Unable to read the list file {} {}".format(list_file, e))
+        exit(1)
+
+    with inventory:
+        if os.fstat(inventory.fileno()).st_size == 0:
+            return
+
+        with mmap.mmap(inventory.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            lines = (line.decode("UTF-8", "surrogateescape") for line in iter(mapped.readline, b""))
+
+            if column is None:
+                for line in lines:
+                    file = line.rstrip("\r\n")
+                    if file:
+                        yield file
+            else:
+                # A quoted field may hold a newline, in which case the CSV reader asks
+                # for the following line as well.
+                checked = False
+                for row in csv.reader(lines):
+                    if not checked and row:
+                        if len(row) <= column:
+                            logger.error("Column {} (counting from 0) isn't among the {} columns of {}".format(column, len(row), list_file))
+                            exit(1)
+                        checked = True
+                    if len(row) > column and row[column]:
+                        yield row[column]
+
+
+def scan_backups(local_dir):
+    '''
+    Find backups in a local directory with os.scandir instead of running a list command.
+    Only regular files are returned. The DirEntry objects are returned as-is so their
+    cached file type and stat data can be reused without another system call per file.
+    '''
+    logger.info("Scanning {} for backups.".format(local_dir))
+    try:
+        with os.scandir(local_dir) as entries:
+            rel_files = [entry for entry in entries if entry.is_file()]
+
+    except OSError as e:
+        logger.error("Unable to scan {} for backups {}".format(local_dir, e))
+        return False
+
+    if len(rel_files) > 0:
+        logger.info("Found {} backups.".format(len(rel_files)))
+        return rel_files
+
     else:
-        for file in rel_files:
-            if file not in files_to_keep:
+        logger.warning("No backups found")
+        return False
 
-                try:
-                    # If backups are to be removed from the local filesystem using a specific command
-                    if local_dir and delete_command:
-                        full_path = local_dir + file
-
-                        # Escape the path with quotes to prevent issues with file paths containing spaces
-                        full_path = shlex.quote(full_path)
-
-                        # Add the absolute path for the backup to delete to the delete command
-                        command = delete_command + full_path
-                        exit_code = subprocess.run(command, shell=True, capture_output=True)
-
-                        if exit_code.returncode != 0:
-                            logging.error("{}: an error occurred when attempting to delete {}".format(backup_name, file))
-                        
-                        else:
-                            logging.info("Successfully removed backup: {}".format(file))
-
-                    # If backups are to be removed from the local filesystem
-                    if local_dir and not delete_command:
-                        full_path = local_dir + file
-                        full_path = shlex.quote(full_path)
-                        # print("Backup to remove: {}".format(full_path))
-                        os.remove(full_path)
-                        logging.info("Successfully removed backup: {}".format(file))
 
+def scan_directory(local_dir, relative_dir):
+    '''
+    Scan one directory of a backup tree. Returns the paths of its regular files and its
+    sub directories, relative to local_dir. Symbolic links to directories aren't followed.
+    '''
+    files = []
+    sub_dirs = []
+    try:
+        with os.scandir(os.path.join(local_dir, relative_dir)) as entries:
+            for entry in entries:
+                path = os.path.join(relative_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append(path)
+                elif entry.is_file():
+                    files.append(path)
 
-                    # If backups are removed exclusively with a delete command.
-                    if delete_command and not local_dir:
-                        command = delete_command + file
-                        exit_code = subprocess.run(command, shell=True, capture_output=True)
+    except OSError as e:
+        logger.error("Unable to scan {} for backups {}".format(os.path.join(local_dir, relative_dir), e))
 
-                        if exit_code.returncode != 0:
-                            logging.error("{}: an error occurred when attempting to delete {}".format(backup_name, file))
-                        
-                        else:
-                            logging.info("Successfully removed backup: {}".format(file))
+    return files, sub_dirs
 
 
+def scan_tree(local_dir, workers=8):
+    '''
+    Find every backup below a local directory. Directories are scanned by a pool of
+    worker threads, and each sub directory is queued as soon as its parent has been
+    scanned, so on a high latency mount many directories are listed at the same time.
+    Returns the paths of the backups relative to local_dir.
+    '''
+    logger.info("Scanning {} and its sub directories for backups.".format(local_dir))
+    rel_files = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan_directory, local_dir, "")}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, sub_dirs = future.result()
+                rel_files.extend(files)
+                pending.update(executor.submit(scan_directory, local_dir, sub_dir) for sub_dir in sub_dirs)
 
-                
-                except FileNotFoundError:
-                    logging.error("There is a problem with the delete command. {} wasn't found")
-                    exit(1)
+    logger.info("Found {} backups.".format(len(rel_files)))
+    return rel_files
 
 
+def group_backups(rel_files, group_depth=1):
+    '''
+    Group backup paths by their first group_depth directories, e.g. with a depth of 1
+    "host1/2024/backup_01_01_2024.tar" belongs to the "host1" group. Backups less deep
+    than the group depth are grouped by the directories they do have.
+    '''
+    groups = {}
+    for file in rel_files:
+        group = "/".join(file.split("/")[:-1][:group_depth])
+        if group in groups:
+            groups[group].append(file)
+        else:
+            groups[group] = [file]
 
-def remove_old_backups(backup_list_command, backup_name, copies_to_keep=4, local_dir=False, delete_command=False, dry_run=False):
+    return groups
 
-    # Ensure a minimum number of backups are retained.
-    
-    if not copies_to_keep >= 3:
-        sys.exit("Must retain a minimum of 3 backups!")
-        
 
-    rel_files = find_backups(backup_list_command)
-    
+def open_index(index_file):
+    '''
+    Open the backup index, creating its tables if needed. The index stores every known
+    backup with its parsed date, and when each backup set was last fully listed.
+    '''
+    db = sqlite3.connect(index_file, timeout=30)
+    db.execute("CREATE TABLE IF NOT EXISTS backups (backup_name TEXT, file TEXT, ordinal INTEGER, PRIMARY KEY (backup_name, file))")
+    db.execute("CREATE TABLE IF NOT EXISTS listings (backup_name TEXT PRIMARY KEY, full_listing REAL)")
+    return db
 
-    # If backups were found
-    if rel_files:
-        dates, file_and_date = extract_date(rel_files, copies_to_keep=copies_to_keep)
 
-        # Ensure a minimum number of backups are retained.
-        if dates:
+def indexed_backups(index_file, backup_name, list_command, local_dir=False, refresh_command=False, full_listing_hours=24, skip_invalid=False):
+    '''
+    Find backups using the backup index instead of listing every backup on each run.
+    If a refresh command is given and the backup set was fully listed within the last
+    full_listing_hours, only the refresh command is run (e.g. one listing the backups
+    added in the last day) and its backups are added to the index. Otherwise the full
+    listing is run and the index is reconciled with it, dropping backups that no longer
+    exist. When only the refresh command is run, backups in a local directory that were
+    removed outside the program since the last full listing are dropped as well, so
+    they don't count towards the copies kept. Returns a dict of each known backup and
+    its parsed date, or False. With skip_invalid, backups without a properly formatted
+    date are stored without one.
+    '''
+    with closing(open_index(index_file)) as db:
+        now = time.time()
+        last_listing = db.execute("SELECT full_listing FROM listings WHERE backup_name = ?", (backup_name,)).fetchone()
+
+        if refresh_command and last_listing and now - last_listing[0] < full_listing_hours * 3600:
+            logger.info("Refreshing the backup index for {} using command: {}.".format(backup_name, refresh_command))
+            try:
+                new_files = list(stream_backups(refresh_command))
+            except subprocess.CalledProcessError:
+                logger.warning("Unable to refresh the backup index for {}".format(backup_name))
+                return False
 
-            files_to_keep = identify_old_backups(dates, file_and_date, copies_to_keep)
-            
-            delete_old_backups(rel_files, files_to_keep, backup_name, local_dir, delete_command, dry_run)
-            logging.info("\n")
+            with db:
+                db.executemany("INSERT OR IGNORE INTO backups VALUES (?, ?, ?)", ((backup_name, file, parse_backup_date(file, skip_invalid)) for file in new_files))
+                if local_dir:
+                    known = [file for (file,) in db.execute("SELECT file FROM backups WHERE backup_name = ?", (backup_name,))]
+                    gone = [file for file in known if not os.path.lexists(local_dir + file)]
+                    db.executemany("DELETE FROM backups WHERE backup_name = ? AND file = ?", ((backup_name, file) for file in gone))
+                    if gone:
+                        logger.info("Backup index for {}: {} backups no longer found in {}.".format(backup_name, len(gone), local_dir))
 
         else:
-            logging.warning("Insufficient backups are being maintained")
+            logger.info("Reconciling the backup index for {} with a full listing.".format(backup_name))
+            if list_command:
+                rel_files = find_backups(list_command)
+            else:
+                entries = scan_backups(local_dir)
+                rel_files = [entry.name for entry in entries] if entries else False
+            if not rel_files:
+                return False
 
+            listed = set(rel_files)
+            known = {file for (file,) in db.execute("SELECT file FROM backups WHERE backup_name = ?", (backup_name,))}
+            with db:
+                db.executemany("DELETE FROM backups WHERE backup_name = ? AND file = ?", ((backup_name, file) for file in known - listed))
+                db.executemany("INSERT INTO backups VALUES (?, ?, ?)", ((backup_name, file, parse_backup_date(file, skip_invalid)) for file in listed - known))
+                db.execute("INSERT OR REPLACE INTO listings VALUES (?, ?)", (backup_name, now))
+            logger.info("Backup index for {}: {} backups added, {} no longer listed.".format(backup_name, len(listed - known), len(known - listed)))
 
+        known_dates = dict(db.execute("SELECT file, ordinal FROM backups WHERE backup_name = ?", (backup_name,)))
 
+    logger.info("Found {} backups in the backup index.".format(len(known_dates)))
+    return known_dates
 
-if __name__ == "__main__":
-    logging.basicConfig(filename="remove_old_backups.log",format="%(asctime)s:%(levelname)s:%(message)s", level=logging.DEBUG)
 
-    parser = argparse.ArgumentParser(add_help=True)
-    parser.add_argument("list_command", help="Command to list backup files.", type=str)
-    parser.add_argument("backup_name", help="What the backups are of/for.", type=str)
-    parser.add_argument('-k', dest='copies_to_keep', help='Number of backups to retain.', type=int, default=4)
-    parser.add_argument('-l', dest='local_dir', help='Local filesystem directory where the backup files are stored.', default=False)
-    parser.add_argument('-c', dest='delete_command', help='Specific command to run to delete old backup files. Useful for removing backups from cloud storage with a program like rclone.', default=False)
-    parser.add_argument('-n', action='store_true', dest='dry_run', help='Perform a dry run. Don\'t remove backups, only print backups to be removed', default=False)
-    args = parser.parse_args()
+def forget_backups(index_file, backup_name, removed):
+    '''
+    Remove deleted backups from the backup index.
+    '''
+    with closing(open_index(index_file)) as db, db:
+        db.executemany("DELETE FROM backups WHERE backup_name = ? AND file = ?", ((backup_name, file) for file in removed))
+
+
+def batch_size_limit():
+    '''
+    Determine how many bytes of paths can be appended to a single delete command. The
+    command is handed to the shell as one string, so it is bound by the per-argument
+    limit (MAX_ARG_STRLEN on Linux) as well as by ARG_MAX minus the environment.
+    '''
+    try:
+        arg_max = os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        arg_max = 131072
+
+    environment_size = sum(len(key) + len(value) + 2 for key, value in os.environ.items())
+    return min(arg_max - environment_size, 131072) - 4096
+
+
+def split_delete_command(delete_command, local_dir=False):
+    '''
+    Split a delete command into the program to run and the path prefix glued to each
+    backup name. "rm /backups/" becomes ("rm", "/backups/") while "rclone deletefile "
+    becomes ("rclone deletefile", ""). When a local directory is given it is the prefix.
+    '''
+    if local_dir:
+        return delete_command.strip(), local_dir
+
+    if delete_command.endswith((" ", "\t")):
+        return delete_command.strip(), ""
+
+    command, _, prefix = delete_command.rpartition(" ")
+    if not command:
+        return delete_command, ""
+    return command.strip(), prefix
+
+
+def build_delete_batches(paths, command, limit):
+    '''
+    Group quoted paths into batches so that every resulting command stays within the
+    given size limit. A single path is never split, even if it alone exceeds the limit.
+    '''
+    batch = []
+    size = len(command)
+    for path in paths:
+        quoted = shlex.quote(path)
+        if batch and size + len(quoted) + 1 > limit:
+            yield batch
+            batch = []
+            size = len(command)
+        batch.append(path)
+        size += len(quoted) + 1
+
+    if batch:
+        yield batch
+
+
+def run_batched_delete(files, backup_name, delete_command, local_dir=False, batch_mode="args"):
+    '''
+    Delete many backups per invocation of the delete command. In "args" mode as many
+    quoted paths as the argument limit allows are appended to the command. In "stdin"
+    mode the command is run once as-is and the newline separated paths are written to
+    its standard input (e.g. "xargs rm" or "rclone delete remote: --files-from -").
+
+    When a batch fails and the backups are on the local filesystem, each file is checked
+    to see whether it was removed. Otherwise every file in the failed batch is reported
+    as failed. Returns the lists of removed and failed backups.
+    '''
+    removed = []
+    failed = []
+    command, prefix = split_delete_command(delete_command, local_dir)
+    if batch_mode == "stdin":
+        # The command is run as-is, so only a local directory is prepended to each name.
+        prefix = local_dir or ""
+    path_to_file = {prefix + file: file for file in files}
+
+    if batch_mode == "stdin":
+        batches = [list(path_to_file)] if path_to_file else []
+    else:
+        batches = build_delete_batches(path_to_file, command, batch_size_limit())
+
+    for batch in batches:
+        if batch_mode == "stdin":
+            full_command = delete_command
+            command_input = "".join(path + "\n" for path in batch).encode("UTF-8")
+        else:
+            full_command = command + " " + " ".join(shlex.quote(path) for path in batch)
+            command_input = None
+
+        logger.info("Removing {} backups with a single delete command.".format(len(batch)))
+        exit_code = subprocess.run(full_command, shell=True, input=command_input, capture_output=True)
+
+        for path in batch:
+            file = path_to_file[path]
+            if exit_code.returncode == 0 or (local_dir and not os.path.lexists(path)):
+                removed.append(file)
+                log_backup("Successfully removed backup: {}", file)
+            else:
+                failed.append(file)
+                logger.error("{}: an error occurred when attempting to delete {}".format(backup_name, file))
+
+    return removed, failed
+
+
+def run_coprocess_delete(files, backup_name, helper_command, local_dir=False, in_flight=1):
+    '''
+    Delete backups through one long-lived helper instead of running the delete command
+    for every backup or batch, so process startup and backend authentication are only
+    paid once. The helper is sent one path per line on its standard input and answers
+    each path in order with a line starting with "OK", or with "ERR" and a message.
+    Up to in_flight paths are sent ahead of their answers, so the round trip to the
+    helper overlaps with the deletions it has already been given. Paths are the local
+    directory followed by the backup name, or the backup name alone. If the helper exits
+    early, the backups it hasn't answered are reported as failed. Returns the lists of
+    removed and failed backups.
+    '''
+    removed = []
+    failed = []
+    prefix = local_dir or ""
+    pending = deque()
+    files = iter(files)
+
+    logger.info("Starting delete helper: {}".format(helper_command))
+    helper = subprocess.Popen(helper_command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def acknowledge():
+        file = pending.popleft()
+        reply = helper.stdout.readline().decode("UTF-8", "replace").strip()
+        if reply == "OK" or reply.startswith("OK "):
+            removed.append(file)
+            log_backup("Successfully removed backup: {}", file)
+        else:
+            failed.append(file)
+            logger.error("{}: an error occurred when attempting to delete {} {}".format(backup_name, file, reply[4:] if reply.startswith("ERR") else "(the delete helper exited)"))
+
+    try:
+        for file in files:
+            if "\n" in file:
+                # A newline would be read as the end of the request.
+                failed.append(file)
+                logger.error("{}: can't pass {} to the delete helper, it contains a newline".format(backup_name, file))
+                continue
+
+            if len(pending) >= in_flight:
+                acknowledge()
+            helper.stdin.write((prefix + file + "\n").encode("UTF-8", "surrogateescape"))
+            helper.stdin.flush()
+            pending.append(file)
+
+    except BrokenPipeError:
+        # The helper has exited. The answers it did send are still read below, and
+        # the backups it was never sent have failed.
+        logger.error("{}: the delete helper exited before every backup was sent to it".format(backup_name))
+        failed.append(file)
+        failed.extend(files)
+
+    try:
+        helper.stdin.close()
+    except BrokenPipeError:
+        pass
+
+    while pending:
+        acknowledge()
+
+    helper.stdout.close()
+    if helper.wait() != 0:
+        logger.warning("{}: the delete helper exited with status {}".format(backup_name, helper.returncode))
+
+    return removed, failed
+
+
+class AdaptiveLimit:
+    '''
+    A concurrency limit adjusted AIMD-style, as TCP adjusts its congestion window. Each
+    success grows the limit by 1/limit, so by about one for every limit deletions, up to
+    maximum. A failure, or a deletion taking more than slowdown times as long as the
+    fastest seen, halves it. It is halved at most once per fastest deletion time, so a
+    burst of failures from one overloaded moment only counts once.
+    '''
+    def __init__(self, maximum, slowdown=4):
+        self.maximum = maximum
+        self.slowdown = slowdown
+        self.limit = 1.0
+        self.peak = 1
+        self.fastest = None
+        self.last_decrease = 0
+
+
+    def current(self):
+        return max(int(self.limit), 1)
+
+
+    def succeeded(self, latency):
+        if self.fastest is None or latency < self.fastest:
+            self.fastest = latency
+        if latency > self.fastest * self.slowdown:
+            self.decrease()
+        else:
+            self.limit = min(self.limit + 1 / self.limit, self.maximum)
+            self.peak = max(self.peak, self.current())
+
+
+    def failed(self):
+        self.decrease()
+
+
+    def decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease >= (self.fastest or 0):
+            self.limit = max(self.limit / 2, 1.0)
+            self.last_decrease = now
+
+
+async def delete_concurrently(files, backup_name, delete_command, local_dir=False, max_concurrency=16, retries=3, backoff=0.5, max_backoff=30):
+    '''
+    Run the delete command for every backup, as many at a time as an AdaptiveLimit of up
+    to max_concurrency allows. A failed deletion is retried up to retries times after a
+    random delay of up to backoff seconds, doubled on each attempt to at most max_backoff
+    ("full jitter"), so retries from many failures don't arrive together. A retry waiting
+    out its delay doesn't count towards the limit. A command that can't be started,
+    such as when too many files or processes are open, is retried the same way. The
+    backups can come from a listing that is still being read, so each one is taken from
+    files in a thread, and deletions carry on while the next line is awaited. If the
+    listing fails, the deletions already started are finished before the error is
+    raised. Any other error stops the deletions still running, killing their commands,
+    and is raised. Returns the lists of removed and failed backups, in the order they
+    finished, and the AdaptiveLimit used.
+    '''
+    removed = []
+    failed = []
+    limit = AdaptiveLimit(max_concurrency)
+    slots = asyncio.Condition()
+    active = 0
+
+    async def acquire():
+        nonlocal active
+        async with slots:
+            await slots.wait_for(lambda: active < limit.current())
+            active += 1
+
+    async def release():
+        nonlocal active
+        async with slots:
+            active -= 1
+            slots.notify_all()
+
+    async def delete(file):
+        # The slot for the first attempt is taken before the task is started.
+        if local_dir:
+            command = delete_command + shlex.quote(local_dir + file)
+        else:
+            command = delete_command + file
+
+        for attempt in range(retries + 1):
+            if attempt:
+                await acquire()
+            start = time.monotonic()
+            try:
+                process = await asyncio.create_subprocess_shell(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError as e:
+                logger.warning("{}: unable to start the delete command for {} {}".format(backup_name, file, e))
+                returncode = None
+            else:
+                try:
+                    returncode = await process.wait()
+                except asyncio.CancelledError:
+                    if process.returncode is None:
+                        process.kill()
+                    raise
+            finally:
+                await release()
+
+            if returncode == 0 or (local_dir and not os.path.lexists(local_dir + file)):
+                limit.succeeded(time.monotonic() - start)
+                removed.append(file)
+                log_backup("Successfully removed backup: {}", file)
+                return
+
+            limit.failed()
+            if attempt < retries:
+                await asyncio.sleep(random.uniform(0, min(backoff * 2 ** attempt, max_backoff)))
+
+        failed.append(file)
+        logger.error("{}: an error occurred when attempting to delete {} after {} attempts".format(backup_name, file, retries + 1))
+
+    tasks = set()
+    errors = []
+
+    def finished(task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            errors.append(task.exception())
+
+    loop = asyncio.get_running_loop()
+    listing = iter(files)
+    try:
+        while True:
+            try:
+                file = await loop.run_in_executor(None, next, listing, None)
+            except Exception:
+                # The backups being deleted were selected before the listing failed.
+                if tasks:
+                    await asyncio.wait(tasks)
+                raise
+            if file is None:
+                break
+
+            await acquire()
+            if errors:
+                raise errors[0]
+            task = asyncio.ensure_future(delete(file))
+            tasks.add(task)
+            task.add_done_callback(finished)
+        while tasks and not errors:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        if errors:
+            raise errors[0]
+
+    finally:
+        # Nothing is left running when an error is raised, so no command outlives the
+        # event loop.
+        pending = list(tasks)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    return removed, failed, limit
+
+
+def run_async_delete(files, backup_name, delete_command, local_dir=False, max_concurrency=16, retries=3, backoff=0.5):
+    '''
+    Delete backups with delete_concurrently from an event loop of their own, and log the
+    deletions per second achieved and the highest concurrency reached. Returns the lists
+    of removed and failed backups.
+    '''
+    start = time.perf_counter()
+    removed, failed, limit = asyncio.run(delete_concurrently(files, backup_name, delete_command, local_dir, max_concurrency, retries, backoff))
+    elapsed = time.perf_counter() - start
+    logger.info("{}: {:.1f} deletions/s with up to {} running at once".format(backup_name, len(removed) / elapsed if elapsed else 0, limit.peak))
+    return removed, failed
+
+
+def remove_throttled(full_path, rate, min_size=1024 ** 3, interval=0.1):
+    '''
+    Remove a local backup, first shrinking it with os.truncate by about rate bytes per
+    second if it is at least min_size. Unlinking a large file frees all of its extents
+    at once, which on ext4 and XFS can stall other I/O on the volume for seconds, while
+    truncating it a step at a time spreads that work out. Anything other than a regular
+    file with a single link is removed straight away, as truncating it would change data
+    that is still reachable through another path.
+    '''
+    info = os.lstat(full_path)
+    if stat.S_ISREG(info.st_mode) and info.st_nlink == 1 and info.st_size >= min_size:
+        try:
+            fd = os.open(full_path, os.O_WRONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+        except PermissionError:
+            # Removing a file only needs write access to its directory, so fall back
+            # to a plain unlink.
+            fd = None
+
+        if fd is not None:
+            try:
+                info = os.fstat(fd)
+                if stat.S_ISREG(info.st_mode) and info.st_nlink == 1:
+                    size = info.st_size
+                    step = max(int(rate * interval), 1)
+                    next_step = time.monotonic()
+                    while size > 0:
+                        size = max(size - step, 0)
+                        os.truncate(fd, size)
+                        next_step += interval
+                        delay = next_step - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+            finally:
+                os.close(fd)
+
+    os.remove(full_path)
+
+
+def remove_local_backup(full_path, rate=0, min_size=0):
+    '''
+    Remove a single backup from the local filesystem, returning the error instead of
+    raising it so the result can be gathered from a worker thread. With a rate, large
+    backups are shrunk first by remove_throttled.
+    '''
+    try:
+        if rate:
+            remove_throttled(full_path, rate, min_size)
+        else:
+            os.remove(full_path)
+        return None
+    except OSError as e:
+        return e
+
+
+def run_parallel_local_delete(files, backup_name, local_dir, jobs, rate=0, min_size=0, missing_ok=False):
+    '''
+    Remove backups from the local filesystem with a bounded pool of worker threads. On
+    network filesystems each unlink is a round-trip to the server, so several removals
+    in flight hide most of that latency. Results are logged from the main thread in the
+    order the backups were given. As with the serial loop, a missing backup is treated
+    as a problem with the backup directory, and MissingBackups is raised once every
+    result has been logged, unless missing_ok counts it as already removed. A throttling
+    rate is shared between the workers so the volume as a whole frees about rate bytes
+    per second. Returns the lists of removed and failed backups.
+    '''
+    removed = []
+    failed = []
+    missing = False
+    rate = max(rate // jobs, 1) if rate else 0
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(lambda full_path: remove_local_backup(full_path, rate, min_size), [local_dir + file for file in files])
+
+        for file, error in zip(files, results):
+            if error is None:
+                removed.append(file)
+                log_backup("Successfully removed backup: {}", file)
+            elif missing_ok and isinstance(error, FileNotFoundError):
+                removed.append(file)
+                logger.info("{}: {} was already removed".format(backup_name, file))
+            else:
+                failed.append(file)
+                logger.error("{}: an error occurred when attempting to delete {} {}".format(backup_name, file, error))
+                if isinstance(error, FileNotFoundError):
+                    missing = True
+
+    if missing:
+        raise MissingBackups("There is a problem with the backup directory. One or more backups in {} weren't found".format(local_dir), removed, failed)
+
+    return removed, failed
+
+
+def delete_backups(files, backup_name, local_dir=False, delete_command=False, *, batch_mode=False, jobs=1, delete_rate=False, throttle_size="1G", missing_ok=False):
+# Delete the given backups. With a delete rate, local backups of at least throttle_size
+# are shrunk at that many bytes per second before being removed. Raises MissingBackups
+# if a backup or the delete command wasn't found, unless missing_ok counts a local
+# backup that is already gone as removed. Returns the lists of removed and failed
+# backups.
+    removed = []
+    failed = []
+    rate = parse_size(delete_rate) if delete_rate else 0
+    min_size = parse_size(throttle_size)
+
+    if batch_mode == "async" and delete_command:
+        removed, failed = run_async_delete(files, backup_name, delete_command, local_dir, jobs)
+
+    elif batch_mode == "coprocess" and delete_command:
+        removed, failed = run_coprocess_delete(files, backup_name, delete_command, local_dir, jobs)
+
+    elif batch_mode and delete_command:
+        removed, failed = run_batched_delete(files, backup_name, delete_command, local_dir, batch_mode)
+
+    elif local_dir and not delete_command and jobs > 1:
+        removed, failed = run_parallel_local_delete(list(files), backup_name, local_dir, jobs, rate, min_size, missing_ok)
+
+    else:
+        for file in files:
+
+            try:
+                # If backups are to be removed from the local filesystem using a specific command
+                if local_dir and delete_command:
+                    full_path = local_dir + file
+
+                    # Escape the path with quotes to prevent issues with file paths containing spaces
+                    full_path = shlex.quote(full_path)
+
+                    # Add the absolute path for the backup to delete to the delete command
+                    command = delete_command + full_path
+                    exit_code = subprocess.run(command, shell=True, capture_output=True)
+
+                    if exit_code.returncode != 0:
+                        failed.append(file)
+                        logger.error("{}: an error occurred when attempting to delete {}".format(backup_name, file))
+                    
+                    else:
+                        removed.append(file)
+                        log_backup("Successfully removed backup: {}", file)
+
+                # If backups are to be removed from the local filesystem
+                if local_dir and not delete_command:
+                    full_path = local_dir + file
+                    if rate:
+                        remove_throttled(full_path, rate, min_size)
+                    else:
+                        os.remove(full_path)
+                    removed.append(file)
+                    log_backup("Successfully removed backup: {}", file)
+
+
+                # If backups are removed exclusively with a delete command.
+                if delete_command and not local_dir:
+                    command = delete_command + file
+                    exit_code = subprocess.run(command, shell=True, capture_output=True)
+
+                    if exit_code.returncode != 0:
+                        failed.append(file)
+                        logger.error("{}: an error occurred when attempting to delete {}".format(backup_name, file))
+                    
+                    else:
+                        removed.append(file)
+                        log_backup("Successfully removed backup: {}", file)
+
+            except FileNotFoundError:
+                if missing_ok and local_dir and not delete_command:
+                    removed.append(file)
+                    logger.info("{}: {} was already removed".format(backup_name, file))
+                    continue
+                raise MissingBackups("There is a problem with the delete command or backup directory. {} wasn't found".format(file), removed, failed)
+
+    return removed, failed
+
+
+def delete_old_backups(rel_files, files_to_keep, backup_name, local_dir=False, delete_command=False, dry_run=False, *, batch_mode=False, jobs=1, delete_rate=False, throttle_size="1G", missing_ok=False):
+# Delete any backup files that are not the recent backup files selected for retention.
+# The backups to delete are handed to delete_backups as they are found, so a streamed
+# listing is still deleted while it is being read. With missing_ok, a local backup that
+# is already gone is counted as removed. Returns the lists of removed and failed backups.
+    removed = []
+    failed = []
+
+    if dry_run:
+        print("This is a dry run. Not removing any backups.")
+        logger.info("This is a dry run. Not removing any backups.")
+        for file in rel_files:
+            if file not in files_to_keep:
+                print("Backup to be removed: {}".format(file))
+                log_backup("Backup to be removed: {}", file)
+
+    else:
+        files_to_remove = (file for file in rel_files if file not in files_to_keep)
+        try:
+            removed, failed = delete_backups(files_to_remove, backup_name, local_dir, delete_command, batch_mode=batch_mode, jobs=jobs, delete_rate=delete_rate, throttle_size=throttle_size, missing_ok=missing_ok)
+        except MissingBackups as e:
+            logger.error(e)
+            exit(1)
+
+        logger.info("{}: removed {} backups, {} failed".format(backup_name, len(removed), len(failed)))
+
+    return removed, failed
+
+
+def parse_size(size, total=None):
+    '''
+    Convert a size such as "500G", "1.5T" or "4096" to bytes. Units are powers of 1024.
+    A percentage such as "10%" is taken of total, and isn't accepted without one.
+    Raises ValueError if the size can't be read.
+    '''
+    number = str(size).strip().upper()
+    scale = 1
+    percentage = number.endswith("%")
+    if percentage:
+        if total is None:
+            raise ValueError("a percentage such as {} isn't accepted here".format(size))
+        number, scale = number[:-1], total / 100
+
+    else:
+        # Allow "500GB" and "500GiB" as well as "500G".
+        for suffix in ("IB", "B"):
+            if number.endswith(suffix):
+                number = number[:-len(suffix)]
+                break
+
+        units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4, "P": 1024 ** 5}
+        if number and number[-1] in units:
+            number, scale = number[:-1], units[number[-1]]
+
+    try:
+        value = float(number)
+    except ValueError:
+        value = None
+    # Also rejects negative, infinite and NaN sizes.
+    if value is None or not 0 <= value < float("inf"):
+        raise ValueError("invalid size {}, expected a number of bytes such as 500G".format(size))
+    if percentage and value > 100:
+        raise ValueError("invalid percentage {}, expected at most 100%".format(size))
+    return int(value * scale)
+
+
+def size_argument(value):
+    '''
+    Check a size given on the command line, such as 2T, so a mistake is reported as a
+    usage error before anything is listed.
+    '''
+    try:
+        parse_size(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
+def positive_int_argument(value):
+    '''
+    Check a count given on the command line, such as the number of jobs, is at least 1.
+    '''
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise argparse.ArgumentTypeError("invalid count {}, expected a whole number of at least 1".format(value))
+    return count
+
+
+def free_space_argument(value):
+    '''
+    Check a free space target given on the command line, a size or a percentage of the
+    volume such as 10%.
+    '''
+    try:
+        parse_size(value, 100)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return value
+
+
+def split_sized_listing(lines, separator=";"):
+    '''
+    Split listing lines of the form "name;size", as printed by "rclone lsf --format ps",
+    into the backup names and a dict of their sizes in bytes.
+    '''
+    rel_files = []
+    sizes = {}
+    for line in lines:
+        file, _, size = line.rpartition(separator)
+        try:
+            sizes[file] = int(size)
+        except ValueError:
+            logger.error("Missing size for {} in the listing".format(line))
+            exit(1)
+        rel_files.append(file)
+
+    return rel_files, sizes
+
+
+def plan_capacity(file_and_date, files_to_keep, sizes, local_dir=False, target_free=False, max_total_size=False):
+    '''
+    Decide which backups to remove to meet a capacity target instead of removing every
+    backup outside the retention policy. Backups in files_to_keep are never removed. The
+    rest are removed oldest date first until the backups take up no more than
+    max_total_size and the volume holding local_dir has at least target_free available.
+    Free space is read once with os.statvfs and the sizes gathered while listing are
+    subtracted from it, so nothing is measured again. Returns the backups to keep.
+    '''
+    excess = 0
+    if max_total_size:
+        excess = max(excess, sum(sizes.values()) - parse_size(max_total_size))
+
+    if target_free:
+        if not local_dir:
+            logger.error("A free space target needs the local directory holding the backups")
+            exit(1)
+        volume = os.statvfs(local_dir)
+        free = volume.f_bavail * volume.f_frsize
+        target = parse_size(target_free, volume.f_blocks * volume.f_frsize)
+        excess = max(excess, target - free)
+        logger.info("{} bytes available on the volume, target is {} bytes.".format(free, target))
+
+    all_files = {file for files in file_and_date.values() for file in files}
+    capacity_keep = set(all_files)
+    freed = 0
+    for ordinal in sorted(file_and_date):
+        if freed >= excess:
+            break
+        for file in file_and_date[ordinal]:
+            if file not in files_to_keep:
+                capacity_keep.discard(file)
+                freed += sizes.get(file, 0)
+
+    if freed < excess:
+        logger.warning("The capacity target can't be met without removing backups that must be kept, {} bytes short".format(excess - freed))
+    logger.info("Removing {} backups to free {} bytes.".format(len(all_files) - len(capacity_keep), freed))
+    return capacity_keep
+
+
+# inotify event flags, from <sys/inotify.h>.
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_CLOSE_WRITE = 0x00000008
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+inotify_event = struct.Struct("iIII")
+
+
+def open_inotify(local_dir):
+    '''
+    Start watching a directory for backups being written, moved in, moved out or
+    deleted, using inotify through ctypes. Returns the inotify file descriptor.
+    '''
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        raise OSError("inotify isn't available on this system")
+
+    fd = libc.inotify_init1(IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+    if libc.inotify_add_watch(fd, os.fsencode(local_dir), mask) < 0:
+        error = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(error, "Unable to watch {}".format(local_dir))
+
+    return fd
+
+
+def read_inotify_events(fd):
+    '''
+    Read the pending inotify events and yield the mask and filename of each one.
+    '''
+    data = os.read(fd, 65536)
+    offset = 0
+    while offset < len(data):
+        wd, mask, cookie, length = inotify_event.unpack_from(data, offset)
+        offset += inotify_event.size
+        name = data[offset:offset + length].split(b"\0", 1)[0]
+        offset += length
+        yield mask, os.fsdecode(name)
+
+
+def fill_window(local_dir, copies_to_keep):
+    '''
+    Build the retention window for a local directory from a single os.scandir pass.
+    Returns the window and the backups that fell out of it.
+    '''
+    newest = []
+    file_and_date = {}
+    old_backups = []
+    for entry in scan_backups(local_dir) or []:
+        ordinal = parse_backup_date(entry.name, skip_invalid=True)
+        if ordinal is not None:
+            old_backups.extend(add_to_window(newest, file_and_date, entry.name, ordinal, copies_to_keep))
+
+    return newest, file_and_date, old_backups
+
+
+def remove_evicted(old_backups, backup_name, local_dir, delete_command=False, dry_run=False):
+    '''
+    Delete the backups that fell out of the watch window. A backup can be removed by
+    something else between being evicted and being deleted, e.g. when its IN_DELETE
+    event is read after the event that evicted it, so a backup that is already gone is
+    logged and counted as removed instead of ending the watcher. Returns the lists of
+    removed and failed backups.
+    '''
+    if dry_run:
+        return delete_old_backups(old_backups, (), backup_name, local_dir, delete_command, dry_run)
+
+    removed = []
+    failed = []
+    for file in old_backups:
+        try:
+            file_removed, file_failed = delete_backups([file], backup_name, local_dir, delete_command)
+        except MissingBackups:
+            logger.info("{}: {} was already removed".format(backup_name, file))
+            file_removed, file_failed = [file], []
+        removed.extend(file_removed)
+        failed.extend(file_failed)
+
+    logger.info("{}: removed {} backups, {} failed".format(backup_name, len(removed), len(failed)))
+    return removed, failed
+
+
+def watch_backups(local_dir, backup_name, copies_to_keep=4, delete_command=False, dry_run=False, stop=None):
+    '''
+    Keep a local directory pruned as new backups arrive, without rescanning it. The
+    directory is reconciled with one os.scandir pass at startup. After that, inotify
+    reports each backup that is written or moved in, the backup is added to the
+    retention window held in memory, and any backups that fall out of the window are
+    deleted. Backups removed by something else are dropped from the window. If the
+    kernel's event queue overflows, the window is rebuilt with a new scan. Files without
+    a valid date are skipped. Runs until the stop event is set or the program is ended.
+    '''
+    if not copies_to_keep >= 3:
+        sys.exit("Must retain a minimum of 3 backups!")
+
+    fd = open_inotify(local_dir)
+    try:
+        newest, file_and_date, old_backups = fill_window(local_dir, copies_to_keep)
+        remove_evicted(old_backups, backup_name, local_dir, delete_command, dry_run)
+        logger.info("Watching {} for new backups.".format(local_dir))
+
+        while stop is None or not stop.is_set():
+            ready, _, _ = select.select([fd], [], [], 1.0)
+            if not ready:
+                continue
+
+            old_backups = []
+            for mask, file in read_inotify_events(fd):
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning("Missed inotify events for {}, rescanning it".format(local_dir))
+                    newest, file_and_date, old_backups = fill_window(local_dir, copies_to_keep)
+                    continue
+
+                if mask & IN_ISDIR:
+                    continue
+
+                ordinal = parse_backup_date(file, skip_invalid=True)
+                if ordinal is None:
+                    logger.debug("Ignoring {}: missing properly formatted date".format(file))
+                    continue
+
+                if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    if file not in file_and_date.get(ordinal, ()):
+                        log_backup("New backup: {}", file)
+                        old_backups.extend(add_to_window(newest, file_and_date, file, ordinal, copies_to_keep))
+                else:
+                    remove_from_window(newest, file_and_date, file, ordinal)
+
+            if old_backups:
+                remove_evicted(old_backups, backup_name, local_dir, delete_command, dry_run)
+
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def timed_stage(metrics, stage):
+    '''
+    Time a stage of a run and record it in the run metrics, along with any counts the
+    stage adds to the dict it is given. Without metrics this only hands out an unused
+    dict, so instrumentation costs next to nothing when it is turned off.
+    '''
+    counts = {}
+    if metrics is None:
+        yield counts
+        return
+
+    start = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        counts["seconds"] = time.perf_counter() - start
+        metrics["stages"][stage] = counts
+
+
+def local_size(path):
+    '''
+    Return the size of a local backup in bytes, or 0 if it can't be read.
+    '''
+    try:
+        return os.lstat(path).st_size
+    except OSError:
+        return 0
+
+
+def entry_size(entry):
+    '''
+    Return the size of a scanned backup in bytes from its DirEntry, which keeps the
+    result for the next call, or 0 if it can't be read.
+    '''
+    try:
+        return entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        return 0
+
+
+def record_sizes(files, local_dir, sizes):
+    '''
+    Pass backups through unchanged, recording the size of each one before it is removed.
+    '''
+    for file in files:
+        sizes[file] = local_size(local_dir + file)
+        yield file
+
+
+def write_run_report(metrics, report_file):
+    '''
+    Write the metrics of a run to a JSON file.
+    '''
+    with open(report_file, "w") as report:
+        json.dump(metrics, report, indent=2)
+
+
+def prometheus_label(value):
+    # Escape a label value for the Prometheus text format.
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def write_prometheus_metrics(metrics, prometheus_file):
+    '''
+    Write the metrics of a run in the Prometheus text format, for the node_exporter
+    textfile collector. The file is written next to its destination and renamed into
+    place so the collector never reads a partial file.
+    '''
+    backup = prometheus_label(metrics["backup_name"])
+    lines = [
+        "# HELP backup_prune_last_run_timestamp_seconds When the last prune run finished.",
+        "# TYPE backup_prune_last_run_timestamp_seconds gauge",
+        "backup_prune_last_run_timestamp_seconds{{backup=\"{}\"}} {}".format(backup, metrics["finished"]),
+        "# HELP backup_prune_success Whether the last prune run succeeded.",
+        "# TYPE backup_prune_success gauge",
+        "backup_prune_success{{backup=\"{}\"}} {}".format(backup, int(metrics["status"] == "ok")),
+        "# HELP backup_prune_duration_seconds Wall time of the last prune run.",
+        "# TYPE backup_prune_duration_seconds gauge",
+        "backup_prune_duration_seconds{{backup=\"{}\"}} {}".format(backup, metrics["seconds"]),
+    ]
+    for name, description in (("removed", "Backups removed by the last prune run."), ("failed", "Backups that failed to be removed by the last prune run."), ("bytes_freed", "Bytes freed by the last prune run."), ("listing_failed", "Whether the listing of the last prune run failed or found nothing."), ("insufficient_backups", "Whether the last prune run found too few backups to prune."), ("skipped", "Backups without a properly formatted date left alone by the last prune run.")):
+        lines.append("# HELP backup_prune_{} {}".format(name, description))
+        lines.append("# TYPE backup_prune_{} gauge".format(name))
+        lines.append("backup_prune_{}{{backup=\"{}\"}} {}".format(name, backup, int(metrics[name])))
+
+    for metric, description in (("seconds", "Wall time of each stage of the last prune run."), ("items", "Backups handled by each stage of the last prune run.")):
+        lines.append("# HELP backup_prune_stage_{} {}".format(metric, description))
+        lines.append("# TYPE backup_prune_stage_{} gauge".format(metric))
+        for stage, counts in metrics["stages"].items():
+            if metric in counts:
+                lines.append("backup_prune_stage_{}{{backup=\"{}\",stage=\"{}\"}} {}".format(metric, backup, prometheus_label(stage), counts[metric]))
+
+    temporary_file = "{}.{}.tmp".format(prometheus_file, os.getpid())
+    with open(temporary_file, "w") as textfile:
+        textfile.write("\n".join(lines) + "\n")
+    os.replace(temporary_file, prometheus_file)
+
+
+# A backup in a retention plan, with its date and why it is kept or deleted.
+PlanEntry = namedtuple("PlanEntry", ("file", "date", "reason"))
+
+# The backups of one backup set to keep and to delete, newest first, and the backups
+# left out because they don't have a properly formatted date.
+RetentionPlan = namedtuple("RetentionPlan", ("backup_name", "keep", "delete", "skipped"))
+
+
+class RetentionPlanner:
+    '''
+    Plan which backups of a backup set to keep and which to delete without deleting,
+    printing or exiting, so that many backup sets can be planned from one long-lived
+    process. Plans are immutable, so they can be cached, and are carried out by a
+    RetentionExecutor. Problems are raised as RetentionError.
+
+        planner = RetentionPlanner(copies_to_keep=7, gfs_policy={"monthly": 12})
+        plan = planner.plan("desktop backup", listing)
+        executor = RetentionExecutor(delete_command="rclone deletefile my_remote:desktop/")
+        removed, failed = executor.execute(plan)
+
+    The planner compiles its own date formats and caches the dates it has parsed up to
+    a fixed number, so planners with different formats don't affect each other or the
+    formats enabled with use_date_formats.
+    '''
+    def __init__(self, copies_to_keep=4, gfs_policy=None, skip_invalid=False, date_formats=("mdy",)):
+        if copies_to_keep < 3:
+            raise RetentionError("Must retain a minimum of 3 backups!")
+        if gfs_policy:
+            try:
+                check_gfs_policy(gfs_policy)
+            except ValueError as e:
+                raise RetentionError("Invalid gfs_policy: {}".format(e))
+        self.copies_to_keep = copies_to_keep
+        self.gfs_policy = dict(gfs_policy) if gfs_policy else None
+        self.skip_invalid = skip_invalid
+        try:
+            self.date_re, self.date_fields = compile_date_formats(date_formats)
+        except KeyError as e:
+            raise RetentionError("Unknown date format {}".format(e))
+        self.date_ordinal = functools.lru_cache(maxsize=date_cache_size)(calendar_ordinal)
+
+
+    def plan(self, backup_name, rel_files, known_dates=None):
+        '''
+        Plan the retention of the listed backups. Dates in known_dates, such as those
+        stored in the backup index, are used instead of parsing those filenames. Kept
+        backups are among the "newest" dates or were selected by a grandfather-father-son
+        tier ("daily", "weekly", "monthly" or "yearly"), and the others are "expired".
+        A filename without a properly formatted date raises InvalidBackupDate, or with
+        skip_invalid is listed in the skipped entries with the problem as its reason.
+        '''
+        skipped = []
+
+        def parse_date(file):
+            try:
+                return match_backup_date(file, self.date_re, self.date_fields, self.date_ordinal)
+            except InvalidBackupDate as e:
+                if not self.skip_invalid:
+                    raise
+                skipped.append(PlanEntry(file, None, str(e)))
+                return None
+
+        _, file_and_date, _ = group_by_date(rel_files, parse_date, known_dates)
+        reasons = retention_reasons(file_and_date, self.copies_to_keep, self.gfs_policy)
+        keep = []
+        delete = []
+        for ordinal in sorted(file_and_date, reverse=True):
+            day = date.fromordinal(ordinal)
+            reason = reasons.get(ordinal)
+            for file in file_and_date[ordinal]:
+                if reason:
+                    keep.append(PlanEntry(file, day, reason))
+                else:
+                    delete.append(PlanEntry(file, day, "expired"))
+
+        return RetentionPlan(backup_name, tuple(keep), tuple(delete), tuple(skipped))
+
+
+class RetentionExecutor:
+    '''
+    Delete the backups a RetentionPlan marks for deletion, from a local directory or with
+    a delete command as on the command line. Nothing is printed and a missing backup
+    raises MissingBackups instead of exiting, and a delete rate or throttle size that
+    can't be read raises RetentionError when the executor is created. Records go to the
+    "remove_old_backups" logger, which writes nothing unless logging has been configured.
+    '''
+    def __init__(self, local_dir=False, delete_command=False, batch_mode=False, jobs=1, delete_rate=False, throttle_size="1G"):
+        try:
+            if delete_rate:
+                parse_size(delete_rate)
+            parse_size(throttle_size)
+        except ValueError as e:
+            raise RetentionError("Invalid delete rate or throttle size: {}".format(e))
+        if jobs < 1:
+            raise RetentionError("Must delete at least 1 backup at a time")
+        self.local_dir = local_dir
+        self.delete_command = delete_command
+        self.batch_mode = batch_mode
+        self.jobs = jobs
+        self.delete_rate = delete_rate
+        self.throttle_size = throttle_size
+
+
+    def execute(self, plan):
+        '''
+        Delete the backups in plan.delete. Returns the lists of removed and failed backups.
+        '''
+        files = [entry.file for entry in plan.delete]
+        return delete_backups(files, plan.backup_name, self.local_dir, self.delete_command, batch_mode=self.batch_mode, jobs=self.jobs, delete_rate=self.delete_rate, throttle_size=self.throttle_size)
+
+
+def remove_old_backups(backup_list_command, backup_name, copies_to_keep=4, local_dir=False, delete_command=False, dry_run=False, *, batch_mode=False, jobs=1, stream=False, gfs_policy=None, index=False, refresh_command=False, full_listing_hours=24, target_free=False, max_total_size=False, sized_listing=False, recursive=False, group_depth=1, scan_workers=8, skip_invalid=False, delete_rate=False, throttle_size="1G", list_file=False, list_column=None, report=False, prometheus=False):
+    # Returns the lists of removed and failed backups. When a report or prometheus file
+    # is given, the time spent in each stage is recorded and written to it, even if the
+    # run fails part way through.
+    metrics = None
+    if report or prometheus:
+        metrics = {"backup_name": backup_name, "status": "failed", "started": time.time(), "stages": {}, "removed": 0, "failed": 0, "bytes_freed": 0, "listing_failed": False, "insufficient_backups": False, "skipped": 0}
+    start = time.perf_counter()
+    try:
+        return prune_backups(backup_list_command, backup_name, copies_to_keep, local_dir, delete_command, dry_run, batch_mode=batch_mode, jobs=jobs, stream=stream, gfs_policy=gfs_policy, index=index, refresh_command=refresh_command, full_listing_hours=full_listing_hours, target_free=target_free, max_total_size=max_total_size, sized_listing=sized_listing, recursive=recursive, group_depth=group_depth, scan_workers=scan_workers, skip_invalid=skip_invalid, delete_rate=delete_rate, throttle_size=throttle_size, list_file=list_file, list_column=list_column, metrics=metrics)
+
+    finally:
+        if metrics is not None:
+            metrics["seconds"] = time.perf_counter() - start
+            metrics["finished"] = time.time()
+            if report:
+                write_run_report(metrics, report)
+            if prometheus:
+                write_prometheus_metrics(metrics, prometheus)
+
+
+def prune_backups(backup_list_command, backup_name, copies_to_keep=4, local_dir=False, delete_command=False, dry_run=False, *, batch_mode=False, jobs=1, stream=False, gfs_policy=None, index=False, refresh_command=False, full_listing_hours=24, target_free=False, max_total_size=False, sized_listing=False, recursive=False, group_depth=1, scan_workers=8, skip_invalid=False, delete_rate=False, throttle_size="1G", list_file=False, list_column=None, metrics=None):
+    # Find, select and delete old backups, recording each stage in metrics if given.
+    # A listing that failed or found nothing, and too few backups to prune, are recorded
+    # as well, so the run is reported as failed even though no deletion failed.
+    # Returns the lists of removed and failed backups.
+    removed = []
+    failed = []
+    listing_failed = False
+    insufficient_backups = False
+    skipped = 0
+    sizes = {}
+    measure_sizes = metrics is not None and local_dir and not dry_run
+    capacity = bool(target_free or max_total_size)
+    listed_sizes = None
+    scanned_entries = {}
+
+    # Ensure a minimum number of backups are retained.
+    
+    if not copies_to_keep >= 3:
+        sys.exit("Must retain a minimum of 3 backups!")
+        
+
+    # Delete old backups while the listing is still being read. A grandfather-father-son
+    # policy or a capacity target needs every backup before anything can be removed, and
+    # the backup index needs the complete listing, so none of them can be streamed. Nor
+    # can batched or parallel local deletion, which collect every backup to delete first.
+    lazy_delete = batch_mode in (False, "coprocess", "async") and not (local_dir and not delete_command and jobs > 1)
+    if stream and (backup_list_command or list_file) and lazy_delete and not gfs_policy and not index and not capacity and not sized_listing:
+        with timed_stage(metrics, "stream_old_backups") as stage:
+            counts = {}
+            if list_file:
+                old_backups = window_old_backups(read_list_file(list_file, list_column), copies_to_keep, skip_invalid, counts)
+            else:
+                old_backups = stream_old_backups(backup_list_command, copies_to_keep, skip_invalid, counts)
+            if measure_sizes:
+                old_backups = record_sizes(old_backups, local_dir, sizes)
+            try:
+                removed, failed = delete_old_backups(old_backups, (), backup_name, local_dir, delete_command, dry_run, batch_mode=batch_mode, jobs=jobs, delete_rate=delete_rate, throttle_size=throttle_size)
+            except subprocess.CalledProcessError:
+                listing_failed = True
+                logger.warning("The listing ended early, only backups older than the newest {} listed were removed".format(copies_to_keep))
+            else:
+                listing_failed = counts["listed"] == 0
+                insufficient_backups = counts["dates"] < copies_to_keep
+                skipped = counts["skipped"]
+            stage["items"] = len(removed) + len(failed)
+            stage["skipped"] = skipped
+        logger.info("\n")
+
+    # Each group of backups in a tree is pruned on its own. Files without a valid date
+    # in their name are left alone, as a tree may hold more than backups.
+    elif recursive and local_dir:
+        with timed_stage(metrics, "find_backups") as stage:
+            groups = group_backups(scan_tree(local_dir, scan_workers), group_depth)
+            listing_failed = not groups
+            stage["items"] = sum(len(files) for files in groups.values())
+            stage["groups"] = len(groups)
+
+        with timed_stage(metrics, "prune_groups") as stage:
+            examples = []
+            for group, files in sorted(groups.items()):
+                group_name = "{} {}".format(backup_name, group) if group else backup_name
+                known_dates = {file: parse_backup_date(os.path.basename(file), skip_invalid=True) for file in files}
+                rel_files = [file for file in files if known_dates[file] is not None]
+                skipped += len(files) - len(rel_files)
+                examples.extend(file for file in files if known_dates[file] is None)
+                del examples[skipped_examples:]
+
+                dates, file_and_date = extract_date(rel_files, copies_to_keep=copies_to_keep, known_dates=known_dates) if rel_files else (False, False)
+                if dates:
+                    files_to_keep = identify_old_backups(dates, file_and_date, copies_to_keep, gfs_policy)
+                    group_removed, group_failed = delete_old_backups(rel_files, files_to_keep, group_name, local_dir, delete_command, dry_run, batch_mode=batch_mode, jobs=jobs, delete_rate=delete_rate, throttle_size=throttle_size)
+                    removed.extend(group_removed)
+                    failed.extend(group_failed)
+                else:
+                    insufficient_backups = True
+                    logger.warning("{}: insufficient backups are being maintained".format(group_name))
+
+            log_skipped(skipped, examples)
+            stage["items"] = len(removed)
+            stage["failures"] = len(failed)
+            stage["skipped"] = skipped
+            if measure_sizes:
+                sizes = {file: local_size(local_dir + file) for file in removed}
+        logger.info("\n")
+
+    else:
+        with timed_stage(metrics, "find_backups") as stage:
+            # Without a list command the local directory is scanned directly.
+            known_dates = None
+            if index:
+                known_dates = indexed_backups(index, backup_name, backup_list_command, local_dir=local_dir, refresh_command=refresh_command, full_listing_hours=full_listing_hours, skip_invalid=skip_invalid)
+                rel_files = list(known_dates) if known_dates else False
+            elif list_file:
+                logger.info("Reading backups from {}.".format(list_file))
+                rel_files = list(read_list_file(list_file, list_column))
+                logger.info("Found {} backups.".format(len(rel_files)))
+                if rel_files and sized_listing:
+                    rel_files, listed_sizes = split_sized_listing(rel_files)
+            elif backup_list_command:
+                rel_files = find_backups(backup_list_command)
+                if rel_files and sized_listing:
+                    rel_files, listed_sizes = split_sized_listing(rel_files)
+            else:
+                entries = scan_backups(local_dir)
+                rel_files = [entry.name for entry in entries] if entries else False
+                if entries and (capacity or measure_sizes):
+                    # The scan already holds the entries, so their size comes with them.
+                    scanned_entries = {entry.name: entry for entry in entries}
+                if entries and capacity:
+                    listed_sizes = {file: entry_size(entry) for file, entry in scanned_entries.items()}
+
+            if rel_files and capacity and listed_sizes is None:
+                if not local_dir:
+                    logger.error("Capacity targets need backup sizes, use a sized listing or a local directory")
+                    exit(1)
+                listed_sizes = {file: local_size(local_dir + file) for file in rel_files}
+            listing_failed = not rel_files
+            stage["items"] = len(rel_files) if rel_files else 0
+        
+
+        # If backups were found
+        if rel_files:
+            with timed_stage(metrics, "extract_date") as stage:
+                dates, file_and_date = extract_date(rel_files, copies_to_keep=copies_to_keep, known_dates=known_dates, skip_invalid=skip_invalid, counts=stage)
+                stage["items"] = len(rel_files)
+                stage["dates"] = len(file_and_date) if file_and_date else 0
+                skipped = stage["skipped"]
+                if dates and skipped:
+                    # Skipped backups have no date, so they are neither kept nor deleted.
+                    dated = {file for files in file_and_date.values() for file in files}
+                    rel_files = [file for file in rel_files if file in dated]
+
+            # Ensure a minimum number of backups are retained.
+            if dates:
+
+                with timed_stage(metrics, "identify_old_backups") as stage:
+                    files_to_keep = identify_old_backups(dates, file_and_date, copies_to_keep, gfs_policy)
+                    if capacity:
+                        files_to_keep = plan_capacity(file_and_date, files_to_keep, listed_sizes, local_dir=local_dir, target_free=target_free, max_total_size=max_total_size)
+                    stage["items"] = len(files_to_keep)
+                
+                with timed_stage(metrics, "delete_old_backups") as stage:
+                    if listed_sizes is not None:
+                        sizes = listed_sizes
+                    elif measure_sizes:
+                        sizes = {file: entry_size(scanned_entries[file]) if file in scanned_entries else local_size(local_dir + file) for file in rel_files if file not in files_to_keep}
+                    # A backup in the index may have been removed outside the program since
+                    # it was last listed, in which case it only needs to be forgotten.
+                    removed, failed = delete_old_backups(rel_files, files_to_keep, backup_name, local_dir, delete_command, dry_run, batch_mode=batch_mode, jobs=jobs, delete_rate=delete_rate, throttle_size=throttle_size, missing_ok=bool(index))
+                    if index and removed:
+                        forget_backups(index, backup_name, removed)
+                    stage["items"] = len(removed)
+                    stage["failures"] = len(failed)
+                logger.info("\n")
+
+            else:
+                insufficient_backups = True
+                logger.warning("Insufficient backups are being maintained")
+
+    if metrics is not None:
+        metrics["status"] = "ok" if not failed and not listing_failed and not insufficient_backups else "failed"
+        metrics["listing_failed"] = listing_failed
+        metrics["insufficient_backups"] = insufficient_backups
+        metrics["skipped"] = skipped
+        metrics["removed"] = len(removed)
+        metrics["failed"] = len(failed)
+        metrics["bytes_freed"] = sum(sizes.get(file, 0) for file in removed)
+
+    return removed, failed
+
+
+# Settings that can be given for each job in a config file.
+job_settings = ("list_command", "backup_name", "copies_to_keep", "local_dir", "delete_command", "dry_run", "batch_mode", "jobs", "stream", "gfs_policy", "index", "refresh_command", "full_listing_hours", "target_free", "max_total_size", "sized_listing", "recursive", "group_depth", "scan_workers", "date_formats", "skip_invalid", "delete_rate", "throttle_size", "list_file", "list_column", "report", "prometheus", "timeout")
+
+
+def load_jobs(config_file):
+    '''
+    Read the backup sets to prune from a TOML or JSON config file. The file holds a list
+    of jobs, each a table with the same settings as the command line, and optionally
+    max_jobs (how many run at the same time) and timeout (seconds allowed per job):
+
+        max_jobs = 8
+        timeout = 3600
+
+        [[jobs]]
+        backup_name = "desktop backup"
+        list_command = "rclone lsf my_remote:desktop"
+        delete_command = "rclone deletefile my_remote:desktop/"
+        copies_to_keep = 7
+    '''
+    with open(config_file, "rb") as config:
+        if config_file.endswith(".toml"):
+            if tomllib is None:
+                sys.exit("TOML config files require Python 3.11 or later. Use a JSON config file instead.")
+            settings = tomllib.load(config)
+        else:
+            settings = json.load(config)
+
+    jobs = settings.get("jobs", [])
+    for job in jobs:
+        unknown = set(job) - set(job_settings)
+        if unknown or "backup_name" not in job:
+            sys.exit("Invalid job in {}: {}".format(config_file, job))
+        if not job.get("list_command") and not job.get("list_file") and not job.get("local_dir"):
+            sys.exit("Job {} needs a list_command, a list_file or a local_dir".format(job["backup_name"]))
+        if job.get("target_free") and not job.get("local_dir"):
+            sys.exit("Job {} needs a local_dir to use target_free".format(job["backup_name"]))
+        if job.get("index") and job.get("sized_listing"):
+            sys.exit("Job {} can't combine index with sized_listing".format(job["backup_name"]))
+        if job.get("gfs_policy"):
+            try:
+                check_gfs_policy(job["gfs_policy"])
+            except ValueError as e:
+                sys.exit("Job {} has an invalid gfs_policy: {}".format(job["backup_name"], e))
+        jobs_setting = job.get("jobs", 1)
+        if not isinstance(jobs_setting, int) or isinstance(jobs_setting, bool) or jobs_setting < 1:
+            sys.exit("Job {} has an invalid jobs: {}, expected a whole number of at least 1".format(job["backup_name"], jobs_setting))
+        for setting, total in (("target_free", 100), ("max_total_size", None), ("delete_rate", None), ("throttle_size", None)):
+            if job.get(setting):
+                try:
+                    parse_size(job[setting], total)
+                except ValueError as e:
+                    sys.exit("Job {} has an invalid {}: {}".format(job["backup_name"], setting, e))
+
+    return jobs, settings.get("max_jobs", 4), settings.get("timeout", None)
+
+
+def run_job(job, connection):
+    '''
+    Run one job in a forked worker and send the number of removed and failed backups
+    back to the scheduler. The worker leads its own process group so that it can be
+    stopped together with any list or delete commands it started.
+    '''
+    os.setpgid(0, 0)
+    log_directly()
+    if "date_formats" in job:
+        use_date_formats(job["date_formats"])
+    settings = {setting: value for setting, value in job.items() if setting not in ("list_command", "date_formats", "timeout")}
+    removed, failed = remove_old_backups(job.get("list_command", False), **settings)
+    connection.send((len(removed), len(failed)))
+    connection.close()
+
+
+def run_jobs(jobs, max_jobs=4, timeout=None):
+    '''
+    Prune many backup sets from one process. Up to max_jobs jobs run at the same time,
+    each in a worker forked from this process so that the interpreter and logging are
+    only set up once and a job calling exit can't end the others. A job running longer
+    than its timeout is stopped along with its commands. Returns a summary of each job:
+    its backup name, status, removed and failed counts, and run time in seconds.
+    '''
+    context = multiprocessing.get_context("fork")
+    pending = list(jobs)
+    running = {}
+    summary = []
+
+    while pending or running:
+        while pending and len(running) < max_jobs:
+            job = pending.pop(0)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_job, args=(job, sender))
+            process.start()
+            sender.close()
+            try:
+                os.setpgid(process.pid, process.pid)
+            except OSError:
+                pass
+            job_timeout = job.get("timeout", timeout)
+            started = time.monotonic()
+            deadline = started + job_timeout if job_timeout else None
+            running[process.sentinel] = (job, process, receiver, started, deadline)
+            logger.info("Started job: {}".format(job["backup_name"]))
+
+        deadlines = [entry[4] for entry in running.values() if entry[4] is not None]
+        wait_time = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+        finished = multiprocessing.connection.wait(list(running), timeout=wait_time)
+
+        now = time.monotonic()
+        for sentinel in list(running):
+            job, process, receiver, started, deadline = running[sentinel]
+            if sentinel in finished:
+                status = "failed"
+                removed = failed = 0
+                process.join()
+                try:
+                    removed, failed = receiver.recv()
+                    status = "ok" if failed == 0 and process.exitcode == 0 else "failed"
+                except EOFError:
+                    # The job exited without reporting a result.
+                    pass
+
+            elif deadline is not None and now >= deadline:
+                status = "timeout"
+                removed = failed = 0
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                process.join()
+                logger.error("{}: job didn't finish within {} seconds".format(job["backup_name"], deadline - started))
+
+            else:
+                continue
+
+            receiver.close()
+            del running[sentinel]
+            summary.append((job["backup_name"], status, removed, failed, now - started))
+            logger.info("Finished job: {} ({})".format(job["backup_name"], status))
+
+    return summary
+
+
+def print_summary(summary):
+    '''
+    Print and log one line per job followed by the totals.
+    '''
+    lines = ["{:<30} {:<8} {:>8} {:>8} {:>10}".format("backup", "status", "removed", "failed", "seconds")]
+    for backup_name, status, removed, failed, seconds in summary:
+        lines.append("{:<30} {:<8} {:>8} {:>8} {:>10.1f}".format(backup_name, status, removed, failed, seconds))
+
+    succeeded = sum(1 for entry in summary if entry[1] == "ok")
+    lines.append("{} of {} jobs succeeded, {} backups removed, {} failed".format(succeeded, len(summary), sum(entry[2] for entry in summary), sum(entry[3] for entry in summary)))
+    for line in lines:
+        print(line)
+        logger.info(line)
+
+
+
+
+if __name__ == "__main__":
+    # A config file replaces the positional arguments, so check for it and the logging
+    # options, which apply in both modes, first.
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument('--config', dest='config_file', default=False)
+    config_parser.add_argument('--queue-logging', action='store_true', dest='queue_logging', default=False)
+    config_parser.add_argument('--log-summary', action='store_true', dest='log_summary', default=False)
+    config_args, remaining_args = config_parser.parse_known_args()
+    configure_logging("remove_old_backups.log", config_args.queue_logging, config_args.log_summary)
+    if config_args.config_file:
+        jobs, max_jobs, timeout = load_jobs(config_args.config_file)
+        summary = run_jobs(jobs, max_jobs, timeout)
+        print_summary(summary)
+        sys.exit(0 if all(entry[1] == "ok" for entry in summary) else 1)
+
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument("list_command", help="Command to list backup files. If omitted, the directory given with -l is scanned directly.", type=str, nargs="?", default=False)
+    parser.add_argument("backup_name", help="What the backups are of/for.", type=str)
+    parser.add_argument('-k', dest='copies_to_keep', help='Number of backups to retain.', type=int, default=4)
+    parser.add_argument('-l', dest='local_dir', help='Local filesystem directory where the backup files are stored.', default=False)
+    parser.add_argument('-c', dest='delete_command', help='Specific command to run to delete old backup files. Useful for removing backups from cloud storage with a program like rclone.', default=False)
+    parser.add_argument('-b', dest='batch_mode', help='Pass many backups to each run of the delete command. "args" appends as many paths as the argument limit allows, "stdin" writes the paths to the command\'s standard input. "coprocess" starts the command once and sends it a path per line, reading back a line starting with OK or ERR for each. "async" runs the command for each backup, several at a time, adjusting how many run at once to the failures and latency seen and retrying failures.', choices=('args', 'stdin', 'coprocess', 'async'), default=False)
+    parser.add_argument('-j', '--jobs', dest='jobs', help='Number of backups to remove from the local directory at the same time. With -b coprocess, the number of paths sent to the delete helper ahead of its answers, and with -b async, the most delete commands run at once.', type=positive_int_argument, default=1)
+    parser.add_argument('-s', action='store_true', dest='stream', help='Remove old backups while the list command output is still being read, keeping only the newest backups in memory.', default=False)
+    parser.add_argument('--daily', dest='daily', help='Number of daily backups to retain in addition to the most recent backups.', type=int, default=0)
+    parser.add_argument('--weekly', dest='weekly', help='Number of weekly backups to retain in addition to the most recent backups.', type=int, default=0)
+    parser.add_argument('--monthly', dest='monthly', help='Number of monthly backups to retain in addition to the most recent backups.', type=int, default=0)
+    parser.add_argument('--yearly', dest='yearly', help='Number of yearly backups to retain in addition to the most recent backups.', type=int, default=0)
+    parser.add_argument('--index', dest='index', help='SQLite file used to remember known backups between runs.', default=False)
+    parser.add_argument('--refresh-command', dest='refresh_command', help='Command listing only the backups added since the last run. Used with --index instead of the list command between full listings.', default=False)
+    parser.add_argument('--full-listing-hours', dest='full_listing_hours', help='Hours between full listings that reconcile the index with the backups that exist.', type=float, default=24)
+    parser.add_argument('--target-free', dest='target_free', help='Instead of removing every backup beyond the ones to retain, remove the oldest only until the volume holding -l has this much space available, e.g. 500G or 10%%.', type=free_space_argument, default=False)
+    parser.add_argument('--max-total-size', dest='max_total_size', help='Instead of removing every backup beyond the ones to retain, remove the oldest only until the backups take up no more than this, e.g. 2T.', type=size_argument, default=False)
+    parser.add_argument('--list-file', dest='list_file', help='Inventory file listing one backup per line to read instead of running a list command. The file is memory mapped, so it can be larger than memory.', default=False)
+    parser.add_argument('--list-column', dest='list_column', help='Read --list-file as CSV and take each backup from this column, counting from 0.', type=int, default=None)
+    parser.add_argument('--sized-listing', action='store_true', dest='sized_listing', help='The list command prints "name;size" for each backup, as "rclone lsf --format ps" does.', default=False)
+    parser.add_argument('-r', '--recursive', action='store_true', dest='recursive', help='Find backups in the sub directories of -l as well, and retain backups separately for each group of sub directories.', default=False)
+    parser.add_argument('--group-depth', dest='group_depth', help='Number of leading directories that identify a group of backups with -r.', type=int, default=1)
+    parser.add_argument('--scan-workers', dest='scan_workers', help='Number of directories scanned at the same time with -r.', type=int, default=8)
+    parser.add_argument('--date-formats', dest='date_formats', help='Date formats to look for in backup filenames: mdy (MM_DD_YYYY), iso (YYYY-MM-DD, optionally followed by a time), ymd (YYYYMMDD) and epoch (seconds since 1970).', choices=tuple(date_formats), nargs='+', default=["mdy"])
+    parser.add_argument('--skip-invalid', action='store_true', dest='skip_invalid', help='Leave backups without a properly formatted date alone and count them instead of exiting.', default=False)
+    parser.add_argument('--delete-rate', dest='delete_rate', help='Shrink local backups of at least --throttle-size with truncate at this many bytes per second before removing them, e.g. 200M, so freeing a large backup doesn\'t stall other I/O on the volume.', type=size_argument, default=False)
+    parser.add_argument('--throttle-size', dest='throttle_size', help='Smallest backup shrunk before being removed with --delete-rate.', type=size_argument, default="1G")
+    parser.add_argument('--report', dest='report', help='JSON file to write the time spent in each stage and the number of backups removed to.', default=False)
+    parser.add_argument('--prometheus', dest='prometheus', help='File to write run metrics to for the node_exporter textfile collector.', default=False)
+    parser.add_argument('--config', dest='config_file', help='TOML or JSON file describing many backup sets to prune at the same time. Replaces the other arguments.', default=False)
+    parser.add_argument('--watch', action='store_true', dest='watch', help='Keep running and remove old backups from the directory given with -l as new backups arrive.', default=False)
+    parser.add_argument('--queue-logging', action='store_true', dest='queue_logging', help='Write the log file from a background thread so slow disks don\'t hold up deletions.', default=False)
+    parser.add_argument('--log-summary', action='store_true', dest='log_summary', help='Log the number of backups removed instead of a line for each one. Failures are still logged.', default=False)
+    parser.add_argument('-n', action='store_true', dest='dry_run', help='Perform a dry run. Don\'t remove backups, only print backups to be removed', default=False)
+    args = parser.parse_args()
+    if not args.list_command and not args.list_file and not args.local_dir:
+        parser.error("a list command is required unless a local directory is given with -l or a list file with --list-file")
+    if args.list_file and (args.list_command or args.index or args.recursive):
+        parser.error("--list-file can't be combined with a list command, --index or -r")
+    if args.list_column is not None and args.list_column < 0:
+        parser.error("--list-column counts from 0")
+    if args.list_column is not None and (not args.list_file or args.sized_listing):
+        parser.error("--list-column requires --list-file and can't be combined with --sized-listing")
+
+    gfs_policy = {tier: getattr(args, tier) for tier in gfs_tiers if getattr(args, tier) > 0}
+    if gfs_policy and args.stream:
+        parser.error("-s can't be combined with --daily, --weekly, --monthly or --yearly")
+    if args.index and args.stream:
+        parser.error("-s can't be combined with --index")
+    if args.stream and (args.batch_mode in ("args", "stdin") or (args.jobs > 1 and not args.batch_mode)):
+        parser.error("-s can't be combined with -b args, -b stdin or -j without -b coprocess or -b async")
+    if args.refresh_command and not args.index:
+        parser.error("--refresh-command requires --index")
+    if args.index and args.sized_listing:
+        parser.error("--index can't be combined with --sized-listing")
+
+    if args.target_free and not args.local_dir:
+        parser.error("--target-free requires -l")
+    if (args.target_free or args.max_total_size or args.sized_listing) and args.stream:
+        parser.error("-s can't be combined with --target-free, --max-total-size or --sized-listing")
+
+    if args.recursive and (args.list_command or not args.local_dir):
+        parser.error("-r requires -l and no list command")
+    if args.recursive and (args.stream or args.index or args.target_free or args.max_total_size):
+        parser.error("-r can't be combined with -s, --index, --target-free or --max-total-size")
+
+    if args.delete_rate and (not args.local_dir or args.delete_command):
+        parser.error("--delete-rate requires -l and no delete command")
+
+    use_date_formats(args.date_formats)
+
+    if args.watch:
+        if not args.local_dir or args.list_command or args.list_file:
+            parser.error("--watch requires -l and no list command or list file")
+        try:
+            watch_backups(args.local_dir, args.backup_name, copies_to_keep=args.copies_to_keep, delete_command=args.delete_command, dry_run=args.dry_run)
+        except KeyboardInterrupt:
+            logger.info("Stopped watching {}.".format(args.local_dir))
+        sys.exit(0)
     
-    remove_old_backups(args.list_command, args.backup_name, copies_to_keep=args.copies_to_keep, local_dir=args.local_dir, delete_command=args.delete_command, dry_run=args.dry_run)
+    remove_old_backups(args.list_command, args.backup_name, copies_to_keep=args.copies_to_keep, local_dir=args.local_dir, delete_command=args.delete_command, dry_run=args.dry_run, batch_mode=args.batch_mode, jobs=args.jobs, stream=args.stream, gfs_policy=gfs_policy, index=args.index, refresh_command=args.refresh_command, full_listing_hours=args.full_listing_hours, target_free=args.target_free, max_total_size=args.max_total_size, sized_listing=args.sized_listing, recursive=args.recursive, group_depth=args.group_depth, scan_workers=args.scan_workers, skip_invalid=args.skip_invalid, delete_rate=args.delete_rate, throttle_size=args.throttle_size, list_file=args.list_file, list_column=args.list_column, report=args.report, prometheus=args.prometheus)
 
@@ -1,6 +1,9 @@
 import unittest
 import shlex
-from datetime import datetime
+import threading
+import tracemalloc
+import sys
+from datetime import date, datetime
 from remove_old_backups import *
 
 file_names = ('some_backup_03_22_2017.zip', 'some_backup_10_01_2022.tar', 'some_backup_07_03_2010.zip', 'some_backup_02_15_2012.zip', 'some_backup_07_24_2015.zip.7z', 'some_backup_12_01_2007.tar.gz')
@@ -40,6 +43,19 @@ class test_dates(unittest.TestCase):
         logging.info("\n")
 
 
+    def test_date_ordinals(self):
+        '''
+        Verify the parsed dates order the same way as the calendar dates.
+        '''
+        test_beginning(self)
+        for file in file_names:
+            self.assertEqual(parse_backup_date(file), datetime.strptime(re.search(r"\d{2}_\d{2}_\d{4}", file).group(), "%m_%d_%Y").toordinal())
+        self.assertGreater(parse_backup_date('some_backup_01_01_2024.zip'), parse_backup_date('some_backup_12_31_2023.zip'))
+        with self.assertRaises(SystemExit):
+            parse_backup_date('some_backup_02_30_2023.zip')
+        logging.info("\n")
+
+
 class test_backup_discovery(unittest.TestCase):
 
     @classmethod
@@ -315,6 +331,1450 @@ class test_backup_command_deletion(unittest.TestCase):
         logging.info("\n")
 
 
+# Fake delete command used to test the batched delete mode. It records one line per
+# invocation and refuses to remove any backup with "locked" in its name.
+fake_delete_command = """#!/bin/sh
+echo "$#" >> /tmp/batch_dir_to_fill/calls.log
+status=0
+if [ "$#" -eq 0 ]; then
+    set -- $(cat)
+fi
+for file in "$@"; do
+    case "$file" in
+        *locked*) status=1 ;;
+        *) rm -f "$file" ;;
+    esac
+done
+exit $status
+"""
+
+
+class test_batched_command_deletion(unittest.TestCase):
+
+    batch_dir = "/tmp/batch_dir_to_fill/"
+    fake_command = "/tmp/fake_delete.sh"
+
+    def setUp(self):
+        os.makedirs(self.batch_dir, exist_ok=True)
+        for file in file_names:
+            open(self.batch_dir + file, "w").close()
+
+        with open(self.fake_command, "w") as script:
+            script.write(fake_delete_command)
+        os.chmod(self.fake_command, 0o755)
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {} {}".format(shlex.quote(self.batch_dir), shlex.quote(self.fake_command)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def delete_command_calls(self):
+        with open(self.batch_dir + "calls.log") as calls:
+            return len(calls.readlines())
+
+
+    def test_batched_delete_single_invocation(self):
+        '''
+        Verify the batched mode removes every old backup with one run of the delete command.
+        '''
+        test_beginning(self)
+        files_to_keep = file_names[:copies_to_keep]
+        removed, failed = delete_old_backups(file_names, files_to_keep, "test", local_dir=self.batch_dir, delete_command=self.fake_command + " ", batch_mode="args")
+        self.assertEqual(sorted(removed), sorted(file_names[copies_to_keep:]))
+        self.assertEqual(failed, [])
+        self.assertEqual(self.delete_command_calls(), 1)
+        self.assertEqual(len(os.listdir(self.batch_dir)), copies_to_keep + 1)
+
+
+    def test_batched_delete_stdin(self):
+        '''
+        Verify the batched mode can pass the backups to the delete command on stdin.
+        '''
+        test_beginning(self)
+        files_to_keep = file_names[:copies_to_keep]
+        removed, failed = delete_old_backups(file_names, files_to_keep, "test", local_dir=self.batch_dir, delete_command=self.fake_command, batch_mode="stdin")
+        self.assertEqual(sorted(removed), sorted(file_names[copies_to_keep:]))
+        self.assertEqual(failed, [])
+        self.assertEqual(self.delete_command_calls(), 1)
+
+
+    def test_batched_delete_reports_failures(self):
+        '''
+        Verify the batched mode reports which backups failed to be removed.
+        '''
+        test_beginning(self)
+        locked_file = "some_backup_locked_01_01_2001.zip"
+        open(self.batch_dir + locked_file, "w").close()
+        rel_files = file_names + (locked_file,)
+        removed, failed = delete_old_backups(rel_files, file_names[:copies_to_keep], "test", local_dir=self.batch_dir, delete_command=self.fake_command + " ", batch_mode="args")
+        self.assertEqual(sorted(removed), sorted(file_names[copies_to_keep:]))
+        self.assertEqual(failed, [locked_file])
+
+
+    def test_batched_delete_respects_size_limit(self):
+        '''
+        Verify backups are split over several delete commands when they don't fit in one.
+        '''
+        test_beginning(self)
+        batches = list(build_delete_batches(["/backups/" + file for file in file_names], "rm", 80))
+        self.assertGreater(len(batches), 1)
+        self.assertEqual(sum(len(batch) for batch in batches), len(file_names))
+        for batch in batches:
+            command = "rm " + " ".join(shlex.quote(path) for path in batch)
+            self.assertTrue(len(command) <= 80 or len(batch) == 1)
+
+
+    def test_split_delete_command(self):
+        '''
+        Verify delete commands are split into the program and the path prefix.
+        '''
+        test_beginning(self)
+        self.assertEqual(split_delete_command("rm /tmp/dir_to_fill/"), ("rm", "/tmp/dir_to_fill/"))
+        self.assertEqual(split_delete_command("rclone deletefile "), ("rclone deletefile", ""))
+        self.assertEqual(split_delete_command("rclone deletefile ", "/tmp/dir_to_fill/"), ("rclone deletefile", "/tmp/dir_to_fill/"))
+
+
+class test_parallel_local_deletion(unittest.TestCase):
+
+    parallel_dir = "/tmp/parallel_dir_to_fill/"
+
+    def setUp(self):
+        os.makedirs(self.parallel_dir, exist_ok=True)
+        for file in file_names:
+            open(self.parallel_dir + file, "w").close()
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {}".format(shlex.quote(self.parallel_dir)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def test_parallel_delete_success(self):
+        '''
+        Verify the worker pool removes old backups from the local filesystem.
+        '''
+        test_beginning(self)
+        list_command = "ls {}".format(self.parallel_dir)
+        remove_old_backups(list_command, "test", copies_to_keep=copies_to_keep, local_dir=self.parallel_dir, jobs=4)
+        rel_files = find_backups(list_command)
+        self.assertEqual(len(rel_files), copies_to_keep)
+
+
+    def test_parallel_delete_results(self):
+        '''
+        Verify the worker pool reports the result for every backup in order.
+        '''
+        test_beginning(self)
+        removed, failed = delete_old_backups(file_names, file_names[:2], "test", local_dir=self.parallel_dir, jobs=3)
+        self.assertEqual(removed, list(file_names[2:]))
+        self.assertEqual(failed, [])
+
+
+    def test_parallel_delete_bad_backup_dir(self):
+        '''
+        Verify the worker pool exits like the serial loop when the backup directory is wrong.
+        '''
+        test_beginning(self)
+        with self.assertRaises(SystemExit):
+            delete_old_backups(file_names, file_names[:2], "test", local_dir="/tmp/qwerpiwqer0930402/", jobs=4)
+
+
+class test_directory_scan(unittest.TestCase):
+
+    scan_dir = "/tmp/scan_dir_to_fill/"
+
+    def setUp(self):
+        os.makedirs(self.scan_dir + "not_a_backup_01_01_2001", exist_ok=True)
+        for file in file_names + ("some_backup_01_02_2003\n.zip",):
+            open(self.scan_dir + file, "w").close()
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {}".format(shlex.quote(self.scan_dir)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def test_scan_returns_files_only(self):
+        '''
+        Verify scanning a directory skips sub directories and keeps names containing newlines.
+        '''
+        test_beginning(self)
+        entries = scan_backups(self.scan_dir)
+        names = sorted(entry.name for entry in entries)
+        self.assertEqual(names, sorted(file_names + ("some_backup_01_02_2003\n.zip",)))
+        self.assertTrue(all(isinstance(entry, os.DirEntry) for entry in entries))
+
+
+    def test_scan_non_existent_dir(self):
+        '''
+        Verify scanning a directory that doesn't exist finds no backups.
+        '''
+        test_beginning(self)
+        self.assertFalse(scan_backups("/tmp/qwerpiwqer0930402/"))
+
+
+    def test_remove_old_backups_without_list_command(self):
+        '''
+        Verify old backups are removed when only a local directory is given.
+        '''
+        test_beginning(self)
+        remove_old_backups(False, "test", copies_to_keep=copies_to_keep, local_dir=self.scan_dir)
+        self.assertEqual(len(scan_backups(self.scan_dir)), copies_to_keep)
+
+
+class test_streaming_listing(unittest.TestCase):
+
+    stream_dir = "/tmp/stream_dir_to_fill/"
+
+    def setUp(self):
+        os.makedirs(self.stream_dir, exist_ok=True)
+        for file in file_names:
+            open(self.stream_dir + file, "w").close()
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {}".format(shlex.quote(self.stream_dir)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def test_stream_backups(self):
+        '''
+        Verify the listing is read one backup at a time.
+        '''
+        test_beginning(self)
+        rel_files = stream_backups("ls {}".format(self.stream_dir))
+        self.assertEqual(sorted(rel_files), sorted(file_names))
+
+
+    def test_failed_list_command(self):
+        '''
+        Verify a listing is ignored when the list command exits with an error.
+        '''
+        test_beginning(self)
+        self.assertFalse(find_backups("ls {}; exit 3".format(self.stream_dir)))
+        with self.assertRaises(subprocess.CalledProcessError):
+            list(stream_backups("ls {}; exit 3".format(self.stream_dir)))
+
+
+    def test_stream_old_backups(self):
+        '''
+        Verify only the backups older than the newest copies to keep are yielded.
+        '''
+        test_beginning(self)
+        old_backups = list(stream_old_backups("ls {}".format(self.stream_dir), copies_to_keep))
+        self.assertEqual(sorted(old_backups), sorted(('some_backup_07_03_2010.zip', 'some_backup_12_01_2007.tar.gz')))
+
+
+    def test_stream_large_listing(self):
+        '''
+        Verify a large listing is handled without building the list of backups.
+        '''
+        test_beginning(self)
+        command = "seq 0 19999 | awk '{printf \"backup_%02d_%02d_%d.tar\\n\", int($1 / 28) % 12 + 1, $1 % 28 + 1, 2000 + int($1 / 336)}'"
+        old_backups = stream_old_backups(command, copies_to_keep)
+        self.assertEqual(sum(1 for file in old_backups), 20000 - copies_to_keep)
+
+
+    def test_remove_old_backups_streaming(self):
+        '''
+        Verify old backups are removed while the listing is being read.
+        '''
+        test_beginning(self)
+        list_command = "ls {}".format(self.stream_dir)
+        remove_old_backups(list_command, "test", copies_to_keep=copies_to_keep, local_dir=self.stream_dir, stream=True)
+        self.assertEqual(len(find_backups(list_command)), copies_to_keep)
+
+
+    def test_batched_deletion_is_not_streamed(self):
+        '''
+        Verify deletion modes that collect every backup first don't stream the listing.
+        '''
+        test_beginning(self)
+        list_command = "ls {}".format(self.stream_dir)
+        metrics = {"stages": {}}
+        prune_backups(list_command, "test", copies_to_keep=copies_to_keep, local_dir=self.stream_dir, stream=True, jobs=4, metrics=metrics)
+        self.assertNotIn("stream_old_backups", metrics["stages"])
+        self.assertEqual(len(find_backups(list_command)), copies_to_keep)
+
+
+def synthetic_backups(count, copies_per_date=1):
+    '''
+    Build a listing of backup filenames with one date per copies_per_date backups.
+    '''
+    start = date(2000, 1, 1).toordinal()
+    dates = ["{0.month:02d}_{0.day:02d}_{0.year:04d}".format(date.fromordinal(start + day)) for day in range(count // copies_per_date + 1)]
+    return ["backup_{}_{}".format(index, dates[index // copies_per_date]) for index in range(count)]
+
+
+class test_retention_planner(unittest.TestCase):
+
+    def test_duplicate_dates_are_grouped(self):
+        '''
+        Verify backups sharing a date are kept or deleted together instead of being dropped.
+        '''
+        test_beginning(self)
+        rel_files = file_names + ('other_backup_10_01_2022.tar', 'other_backup_07_03_2010.zip')
+        dates, file_and_date = extract_date(rel_files, copies_to_keep=copies_to_keep)
+        files_to_keep, files_to_delete = plan_retention(file_and_date, copies_to_keep)
+        self.assertIn('other_backup_10_01_2022.tar', files_to_keep)
+        self.assertIn('other_backup_07_03_2010.zip', files_to_delete)
+        self.assertEqual(len(files_to_keep) + len(files_to_delete), len(rel_files))
+        self.assertFalse(files_to_keep & files_to_delete)
+        logging.info("\n")
+
+
+    def test_keep_newest(self):
+        '''
+        Verify the newest backups are kept whatever order they are listed in.
+        '''
+        test_beginning(self)
+        dates, file_and_date = extract_date(file_names, copies_to_keep=copies_to_keep)
+        files_to_keep = identify_old_backups(dates, file_and_date, copies_to_keep)
+        self.assertEqual(files_to_keep, {'some_backup_03_22_2017.zip', 'some_backup_10_01_2022.tar', 'some_backup_02_15_2012.zip', 'some_backup_07_24_2015.zip.7z'})
+        logging.info("\n")
+
+
+    def test_scaling_unique_dates(self):
+        '''
+        Verify the planner handles 10^6 backups with a large retention window.
+        '''
+        test_beginning(self)
+        rel_files = synthetic_backups(10 ** 6)
+        dates, file_and_date = extract_date(rel_files, copies_to_keep=1000)
+        files_to_keep, files_to_delete = plan_retention(file_and_date, 1000)
+        self.assertEqual(len(files_to_keep), 1000)
+        self.assertEqual(len(files_to_delete), 10 ** 6 - 1000)
+        self.assertEqual(files_to_keep, set(rel_files[-1000:]))
+        logging.info("\n")
+
+
+    def test_scaling_duplicate_dates(self):
+        '''
+        Verify the planner handles 10^6 backups that share dates.
+        '''
+        test_beginning(self)
+        rel_files = synthetic_backups(10 ** 6, copies_per_date=10)
+        dates, file_and_date = extract_date(rel_files, copies_to_keep=copies_to_keep)
+        files_to_keep, files_to_delete = plan_retention(file_and_date, copies_to_keep)
+        self.assertEqual(len(file_and_date), 10 ** 5)
+        self.assertEqual(files_to_keep, set(rel_files[-copies_to_keep * 10:]))
+        self.assertEqual(len(files_to_delete), 10 ** 6 - copies_to_keep * 10)
+        logging.info("\n")
+
+
+class test_gfs_retention(unittest.TestCase):
+
+    def setUp(self):
+        # Two years of nightly backups ending on 12_31_2023.
+        start = date(2022, 1, 1).toordinal()
+        self.rel_files = ["nightly_{0.month:02d}_{0.day:02d}_{0.year:04d}.tar".format(date.fromordinal(start + day)) for day in range(730)]
+        self.dates, self.file_and_date = extract_date(self.rel_files, copies_to_keep=copies_to_keep)
+
+
+    def test_gfs_tiers(self):
+        '''
+        Verify each tier keeps the newest backup of its newest buckets.
+        '''
+        test_beginning(self)
+        gfs_policy = {"daily": 7, "weekly": 4, "monthly": 12, "yearly": 2}
+        files_to_keep, files_to_delete = plan_gfs_retention(self.file_and_date, 3, gfs_policy)
+        self.assertIn("nightly_12_25_2023.tar", files_to_keep)
+        self.assertIn("nightly_12_24_2023.tar", files_to_keep)
+        self.assertNotIn("nightly_12_23_2023.tar", files_to_keep)
+        self.assertIn("nightly_12_10_2023.tar", files_to_keep)
+        self.assertNotIn("nightly_12_03_2023.tar", files_to_keep)
+        self.assertIn("nightly_01_31_2023.tar", files_to_keep)
+        self.assertNotIn("nightly_12_31_2022.tar", files_to_delete)
+        self.assertIn("nightly_11_30_2022.tar", files_to_delete)
+        self.assertEqual(len(files_to_keep) + len(files_to_delete), len(self.rel_files))
+        logging.info("\n")
+
+
+    def test_gfs_keeps_minimum(self):
+        '''
+        Verify the most recent backups are kept even when the policy selects fewer.
+        '''
+        test_beginning(self)
+        files_to_keep = identify_old_backups(self.dates, self.file_and_date, copies_to_keep, {"yearly": 1})
+        self.assertEqual(files_to_keep, {"nightly_12_31_2023.tar", "nightly_12_30_2023.tar", "nightly_12_29_2023.tar", "nightly_12_28_2023.tar"})
+        logging.info("\n")
+
+
+    def test_gfs_minimum_retention(self):
+        '''
+        Verify a policy can't be used to retain fewer than 3 backups.
+        '''
+        test_beginning(self)
+        with self.assertRaises(SystemExit):
+            remove_old_backups('ls /tmp/dir_to_fill', "test", copies_to_keep=1, gfs_policy={"monthly": 12})
+        logging.info("\n")
+
+
+class test_config_jobs(unittest.TestCase):
+
+    config_dir = "/tmp/config_dirs/"
+
+    def setUp(self):
+        for backup_set in ("first", "second"):
+            os.makedirs(self.config_dir + backup_set, exist_ok=True)
+            for file in file_names:
+                open("{}{}/{}".format(self.config_dir, backup_set, file), "w").close()
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {}".format(shlex.quote(self.config_dir)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def write_config(self, name, text):
+        with open(self.config_dir + name, "w") as config:
+            config.write(text)
+        return self.config_dir + name
+
+
+    def test_load_toml_and_json(self):
+        '''
+        Verify jobs are read from TOML and JSON config files.
+        '''
+        test_beginning(self)
+        toml_file = self.write_config("jobs.toml", 'max_jobs = 2\n[[jobs]]\nbackup_name = "first"\nlocal_dir = "/tmp/first/"\ncopies_to_keep = 5\n')
+        json_file = self.write_config("jobs.json", json.dumps({"timeout": 30, "jobs": [{"backup_name": "first", "local_dir": "/tmp/first/", "copies_to_keep": 5}]}))
+        self.assertEqual(load_jobs(toml_file), ([{"backup_name": "first", "local_dir": "/tmp/first/", "copies_to_keep": 5}], 2, None))
+        self.assertEqual(load_jobs(json_file), ([{"backup_name": "first", "local_dir": "/tmp/first/", "copies_to_keep": 5}], 4, 30))
+
+
+    def test_invalid_job(self):
+        '''
+        Verify a job with an unknown setting or settings that can't be combined is rejected.
+        '''
+        test_beginning(self)
+        json_file = self.write_config("jobs.json", json.dumps({"jobs": [{"backup_name": "first", "keep": 5}]}))
+        with self.assertRaises(SystemExit):
+            load_jobs(json_file)
+        json_file = self.write_config("jobs.json", json.dumps({"jobs": [{"backup_name": "first", "list_command": "ls", "index": "index.sqlite", "sized_listing": True}]}))
+        with self.assertRaises(SystemExit):
+            load_jobs(json_file)
+        json_file = self.write_config("jobs.json", json.dumps({"jobs": [{"backup_name": "first", "list_command": "ls", "target_free": "10%"}]}))
+        with self.assertRaises(SystemExit):
+            load_jobs(json_file)
+        for setting in ({"max_total_size": "10%"}, {"max_total_size": "2X"}, {"delete_rate": "fast", "local_dir": "/tmp/"}, {"jobs": 0, "local_dir": "/tmp/"}, {"gfs_policy": {"hourly": 2}}, {"target_free": "150%", "local_dir": "/tmp/"}):
+            json_file = self.write_config("jobs.json", json.dumps({"jobs": [dict({"backup_name": "first", "list_command": "ls"}, **setting)]}))
+            with self.assertRaises(SystemExit):
+                load_jobs(json_file)
+
+
+    def test_run_jobs_concurrently(self):
+        '''
+        Verify jobs run at the same time and each one's result is summarised.
+        '''
+        test_beginning(self)
+        jobs = [
+            {"backup_name": "first", "local_dir": self.config_dir + "first/", "copies_to_keep": copies_to_keep},
+            {"backup_name": "second", "list_command": "sleep 1; ls {}second".format(self.config_dir), "local_dir": self.config_dir + "second/", "copies_to_keep": copies_to_keep},
+            {"backup_name": "slow", "list_command": "sleep 1; ls {}first".format(self.config_dir), "copies_to_keep": copies_to_keep, "dry_run": True},
+            {"backup_name": "too small", "list_command": "ls {}first".format(self.config_dir), "copies_to_keep": 2},
+        ]
+        start = time.monotonic()
+        summary = run_jobs(jobs, max_jobs=4)
+        self.assertLess(time.monotonic() - start, 1.9)
+
+        results = {entry[0]: entry[1:4] for entry in summary}
+        self.assertEqual(results["first"], ("ok", 2, 0))
+        self.assertEqual(results["second"], ("ok", 2, 0))
+        self.assertEqual(results["slow"][0], "ok")
+        self.assertEqual(results["too small"][0], "failed")
+        self.assertEqual(len(os.listdir(self.config_dir + "second")), copies_to_keep)
+
+
+    def test_job_timeout(self):
+        '''
+        Verify a job that runs past its timeout is stopped without affecting the others.
+        '''
+        test_beginning(self)
+        jobs = [
+            {"backup_name": "hung", "list_command": "sleep 30; ls {}first".format(self.config_dir), "local_dir": self.config_dir + "first/", "timeout": 0.5},
+            {"backup_name": "second", "local_dir": self.config_dir + "second/"},
+        ]
+        start = time.monotonic()
+        summary = run_jobs(jobs, max_jobs=1)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual([entry[:2] for entry in summary], [("hung", "timeout"), ("second", "ok")])
+        self.assertEqual(len(os.listdir(self.config_dir + "first")), len(file_names))
+
+
+class test_backup_index(unittest.TestCase):
+
+    index_dir = "/tmp/index_dir_to_fill/"
+    index_file = "/tmp/backup_index.sqlite"
+
+    def setUp(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        for file in file_names:
+            open(self.index_dir + file, "w").close()
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {} {}".format(shlex.quote(self.index_dir), shlex.quote(self.index_file)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def test_full_listing_fills_index(self):
+        '''
+        Verify the first run lists every backup and stores its date in the index.
+        '''
+        test_beginning(self)
+        known_dates = indexed_backups(self.index_file, "test", "ls {}".format(self.index_dir))
+        self.assertEqual(known_dates, {file: parse_backup_date(file) for file in file_names})
+
+
+    def test_refresh_adds_new_backups(self):
+        '''
+        Verify later runs only run the refresh command and add its backups to the index.
+        '''
+        test_beginning(self)
+        list_command = "ls {}".format(self.index_dir)
+        indexed_backups(self.index_file, "test", list_command)
+        open(self.index_dir + "some_backup_01_01_2024.zip", "w").close()
+        known_dates = indexed_backups(self.index_file, "test", "false", refresh_command="echo some_backup_01_01_2024.zip")
+        self.assertEqual(len(known_dates), len(file_names) + 1)
+        self.assertIn("some_backup_01_01_2024.zip", known_dates)
+
+
+    def test_full_listing_reconciles_drift(self):
+        '''
+        Verify a full listing drops backups that were removed outside of the program.
+        '''
+        test_beginning(self)
+        list_command = "ls {}".format(self.index_dir)
+        indexed_backups(self.index_file, "test", list_command)
+        os.remove(self.index_dir + file_names[0])
+        known_dates = indexed_backups(self.index_file, "test", list_command, refresh_command="true", full_listing_hours=0)
+        self.assertEqual(set(known_dates), set(file_names[1:]))
+
+
+    def test_remove_old_backups_updates_index(self):
+        '''
+        Verify removed backups are also removed from the index.
+        '''
+        test_beginning(self)
+        list_command = "ls {}".format(self.index_dir)
+        removed, failed = remove_old_backups(list_command, "test", copies_to_keep=copies_to_keep, local_dir=self.index_dir, index=self.index_file)
+        self.assertEqual(len(removed), len(file_names) - copies_to_keep)
+        known_dates = indexed_backups(self.index_file, "test", "false", refresh_command="true")
+        self.assertEqual(set(known_dates), set(os.listdir(self.index_dir)))
+
+
+    def test_refresh_drops_removed_backups(self):
+        '''
+        Verify backups removed outside of the program between full listings don't count
+        towards the copies kept, and one removed after the index was read is forgotten
+        instead of ending the run.
+        '''
+        test_beginning(self)
+        list_command = "ls {}".format(self.index_dir)
+        indexed_backups(self.index_file, "test", list_command)
+        os.remove(self.index_dir + 'some_backup_10_01_2022.tar')
+        removed, failed = remove_old_backups(list_command, "test", copies_to_keep=copies_to_keep, local_dir=self.index_dir, index=self.index_file, refresh_command="true")
+        self.assertEqual(len(os.listdir(self.index_dir)), copies_to_keep)
+        self.assertEqual(failed, [])
+
+        open(self.index_dir + "some_backup_01_01_2024.zip", "w").close()
+        known_dates = indexed_backups(self.index_file, "test", "false", local_dir=self.index_dir, refresh_command="echo some_backup_01_01_2024.zip")
+        oldest = min(known_dates, key=known_dates.get)
+        os.remove(self.index_dir + oldest)
+        removed, failed = delete_old_backups([oldest], (), "test", local_dir=self.index_dir, missing_ok=True)
+        self.assertEqual(removed, [oldest])
+        with self.assertRaises(SystemExit):
+            delete_old_backups([oldest], (), "test", local_dir=self.index_dir)
+
+
+class test_run_metrics(unittest.TestCase):
+
+    metrics_dir = "/tmp/metrics_dir_to_fill/"
+    report_file = "/tmp/prune_report.json"
+    prometheus_file = "/tmp/prune_metrics.prom"
+
+    def setUp(self):
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        for file in file_names:
+            with open(self.metrics_dir + file, "w") as backup:
+                backup.write("backup")
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {} {} {}".format(shlex.quote(self.metrics_dir), self.report_file, self.prometheus_file), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def test_run_report(self):
+        '''
+        Verify the JSON report records each stage and the bytes freed.
+        '''
+        test_beginning(self)
+        remove_old_backups("ls {}".format(self.metrics_dir), "test", copies_to_keep=copies_to_keep, local_dir=self.metrics_dir, report=self.report_file)
+        with open(self.report_file) as report:
+            metrics = json.load(report)
+        self.assertEqual(metrics["status"], "ok")
+        self.assertEqual(list(metrics["stages"]), ["find_backups", "extract_date", "identify_old_backups", "delete_old_backups"])
+        self.assertEqual(metrics["stages"]["find_backups"]["items"], len(file_names))
+        self.assertEqual(metrics["removed"], len(file_names) - copies_to_keep)
+        self.assertEqual(metrics["bytes_freed"], 6 * (len(file_names) - copies_to_keep))
+
+
+    def test_scanned_bytes_freed(self):
+        '''
+        Verify the bytes freed are measured from the scanned directory entries.
+        '''
+        test_beginning(self)
+        metrics = {"stages": {}}
+        prune_backups(False, "test", copies_to_keep=copies_to_keep, local_dir=self.metrics_dir, metrics=metrics)
+        self.assertEqual(metrics["removed"], len(file_names) - copies_to_keep)
+        self.assertEqual(metrics["bytes_freed"], 6 * (len(file_names) - copies_to_keep))
+
+
+    def test_prometheus_metrics(self):
+        '''
+        Verify the textfile collector file is written in the Prometheus text format.
+        '''
+        test_beginning(self)
+        remove_old_backups("ls {}".format(self.metrics_dir), 'test "quoted"', copies_to_keep=copies_to_keep, local_dir=self.metrics_dir, stream=True, prometheus=self.prometheus_file)
+        with open(self.prometheus_file) as textfile:
+            lines = textfile.read().splitlines()
+        self.assertIn('backup_prune_success{backup="test \\"quoted\\""} 1', lines)
+        self.assertIn('backup_prune_removed{backup="test \\"quoted\\""} 2', lines)
+        self.assertIn('backup_prune_stage_items{backup="test \\"quoted\\"",stage="stream_old_backups"} 2', lines)
+
+
+    def test_failed_run_is_reported(self):
+        '''
+        Verify a run that exits part way through is still reported as failed.
+        '''
+        test_beginning(self)
+        with self.assertRaises(SystemExit):
+            remove_old_backups("ls {}".format(self.metrics_dir), "test", copies_to_keep=copies_to_keep, local_dir="/tmp/qwerpiwqer0930402/", report=self.report_file)
+        with open(self.report_file) as report:
+            self.assertEqual(json.load(report)["status"], "failed")
+
+
+    def test_failed_listing_is_reported(self):
+        '''
+        Verify a failing list command and too few backups are reported as failed runs,
+        with and without streaming.
+        '''
+        test_beginning(self)
+        for stream in (False, True):
+            remove_old_backups("echo some_backup_01_01_2024.zip; exit 3", "t", copies_to_keep=copies_to_keep, stream=stream, delete_command="true ", report=self.report_file, prometheus=self.prometheus_file)
+            with open(self.report_file) as report:
+                metrics = json.load(report)
+            self.assertEqual(metrics["status"], "failed")
+            self.assertTrue(metrics["listing_failed"])
+            with open(self.prometheus_file) as textfile:
+                lines = textfile.read().splitlines()
+            self.assertIn('backup_prune_success{backup="t"} 0', lines)
+            self.assertIn('backup_prune_listing_failed{backup="t"} 1', lines)
+
+        remove_old_backups("ls {} | head -2".format(self.metrics_dir), "t", copies_to_keep=copies_to_keep, local_dir=self.metrics_dir, report=self.report_file)
+        with open(self.report_file) as report:
+            metrics = json.load(report)
+        self.assertEqual(metrics["status"], "failed")
+        self.assertTrue(metrics["insufficient_backups"])
+
+
+class test_logging_modes(unittest.TestCase):
+
+    log_dir = "/tmp/log_dir_to_fill/"
+
+    def setUp(self):
+        os.makedirs(self.log_dir + "backups", exist_ok=True)
+        for file in file_names:
+            open(self.log_dir + "backups/" + file, "w").close()
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {}".format(shlex.quote(self.log_dir)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def run_program(self, *options):
+        script = os.path.abspath("remove_old_backups.py")
+        command = [sys.executable, script, "test", "-l", self.log_dir + "backups/"] + list(options)
+        subprocess.run(command, cwd=self.log_dir, check=True, capture_output=True)
+        with open(self.log_dir + "remove_old_backups.log") as log:
+            return log.read()
+
+
+    def test_queued_logging(self):
+        '''
+        Verify every line reaches the log file when it is written from a background thread.
+        '''
+        test_beginning(self)
+        log = self.run_program("--queue-logging")
+        self.assertEqual(log.count("Successfully removed backup"), len(file_names) - copies_to_keep)
+        self.assertIn(":INFO:test: removed 2 backups, 0 failed", log)
+
+
+    def test_summary_logging(self):
+        '''
+        Verify the summary level leaves out the line for each removed backup.
+        '''
+        test_beginning(self)
+        log = self.run_program("--queue-logging", "--log-summary")
+        self.assertNotIn("Successfully removed backup", log)
+        self.assertIn(":INFO:test: removed 2 backups, 0 failed", log)
+
+
+class test_watch_mode(unittest.TestCase):
+
+    watch_dir = "/tmp/watch_dir_to_fill/"
+
+    def setUp(self):
+        os.makedirs(self.watch_dir, exist_ok=True)
+        for file in file_names + ("notes.txt",):
+            open(self.watch_dir + file, "w").close()
+
+        self.stop = threading.Event()
+        self.watcher = threading.Thread(target=watch_backups, args=(self.watch_dir, "test", copies_to_keep), kwargs={"stop": self.stop})
+        self.watcher.start()
+
+
+    def tearDown(self):
+        self.stop.set()
+        self.watcher.join()
+        subprocess.run("rm -r {}".format(shlex.quote(self.watch_dir)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return condition()
+
+
+    def test_startup_reconcile(self):
+        '''
+        Verify old backups are removed on startup and files without dates are left alone.
+        '''
+        test_beginning(self)
+        self.assertTrue(self.wait_for(lambda: len(os.listdir(self.watch_dir)) == copies_to_keep + 1))
+        self.assertIn("notes.txt", os.listdir(self.watch_dir))
+
+
+    def test_new_backup_prunes_oldest(self):
+        '''
+        Verify a new backup causes the oldest backup in the window to be removed.
+        '''
+        test_beginning(self)
+        self.assertTrue(self.wait_for(lambda: len(os.listdir(self.watch_dir)) == copies_to_keep + 1))
+        with open(self.watch_dir + "some_backup_01_01_2024.zip", "w") as backup:
+            backup.write("backup")
+        self.assertTrue(self.wait_for(lambda: not os.path.exists(self.watch_dir + "some_backup_02_15_2012.zip")))
+        self.assertTrue(os.path.exists(self.watch_dir + "some_backup_01_01_2024.zip"))
+
+        # An old backup moved into the directory is removed straight away.
+        open("/tmp/some_backup_01_01_2000.zip", "w").close()
+        os.rename("/tmp/some_backup_01_01_2000.zip", self.watch_dir + "some_backup_01_01_2000.zip")
+        self.assertTrue(self.wait_for(lambda: not os.path.exists(self.watch_dir + "some_backup_01_01_2000.zip")))
+        self.assertEqual(len(os.listdir(self.watch_dir)), copies_to_keep + 1)
+
+
+    def test_deleted_backup_leaves_window(self):
+        '''
+        Verify a backup deleted by something else no longer counts towards the window.
+        '''
+        test_beginning(self)
+        self.assertTrue(self.wait_for(lambda: len(os.listdir(self.watch_dir)) == copies_to_keep + 1))
+        os.remove(self.watch_dir + "some_backup_10_01_2022.tar")
+        open(self.watch_dir + "some_backup_01_01_2014.zip", "w").close()
+        time.sleep(0.5)
+        self.assertEqual(len(os.listdir(self.watch_dir)), copies_to_keep + 1)
+
+
+    def test_evicted_backup_already_removed(self):
+        '''
+        Verify an evicted backup removed by something else before the watcher deletes it
+        is counted as removed instead of ending the watcher.
+        '''
+        test_beginning(self)
+        self.assertTrue(self.wait_for(lambda: len(os.listdir(self.watch_dir)) == copies_to_keep + 1))
+        open(self.watch_dir + "some_backup_01_01_2000.zip", "w").close()
+        os.remove(self.watch_dir + "some_backup_01_01_2000.zip")
+        removed, failed = remove_evicted(["some_backup_01_01_2000.zip"], "test", self.watch_dir)
+        self.assertEqual(removed, ["some_backup_01_01_2000.zip"])
+        self.assertEqual(failed, [])
+        self.assertTrue(self.watcher.is_alive())
+
+
+class test_capacity_target(unittest.TestCase):
+
+    capacity_dir = "/tmp/capacity_dir_to_fill/"
+
+    def setUp(self):
+        os.makedirs(self.capacity_dir, exist_ok=True)
+        for file in file_names:
+            with open(self.capacity_dir + file, "w") as backup:
+                backup.write("x" * 1000)
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {}".format(shlex.quote(self.capacity_dir)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def test_parse_size(self):
+        '''
+        Verify sizes with units and percentages are converted to bytes, and sizes that
+        can't be read are rejected.
+        '''
+        test_beginning(self)
+        self.assertEqual(parse_size("4096"), 4096)
+        self.assertEqual(parse_size("2K"), 2048)
+        self.assertEqual(parse_size("1.5GiB"), 1536 * 1024 ** 2)
+        self.assertEqual(parse_size("10%", 5000), 500)
+        for size, total in (("10%", None), ("2X", None), ("-5G", None), ("", None), ("150%", 5000)):
+            with self.assertRaises(ValueError):
+                parse_size(size, total)
+
+
+    def test_max_total_size(self):
+        '''
+        Verify only the oldest backups needed to get under the size limit are removed.
+        '''
+        test_beginning(self)
+        removed, failed = remove_old_backups(False, "test", copies_to_keep=3, local_dir=self.capacity_dir, max_total_size=5000)
+        self.assertEqual(removed, ["some_backup_12_01_2007.tar.gz"])
+        self.assertEqual(len(os.listdir(self.capacity_dir)), len(file_names) - 1)
+
+
+    def test_retention_floor(self):
+        '''
+        Verify backups that must be retained are kept even when the target isn't met.
+        '''
+        test_beginning(self)
+        remove_old_backups(False, "test", copies_to_keep=copies_to_keep, local_dir=self.capacity_dir, max_total_size=0)
+        self.assertEqual(len(os.listdir(self.capacity_dir)), copies_to_keep)
+
+
+    def test_target_free(self):
+        '''
+        Verify nothing is removed when the volume already has the free space required,
+        and that a free space target without a local directory is refused.
+        '''
+        test_beginning(self)
+        removed, failed = remove_old_backups(False, "test", copies_to_keep=3, local_dir=self.capacity_dir, target_free="1K")
+        self.assertEqual(removed, [])
+        self.assertEqual(len(os.listdir(self.capacity_dir)), len(file_names))
+        with self.assertRaises(SystemExit):
+            plan_capacity({1: ["a_01_01_2024.tar"]}, set(), {"a_01_01_2024.tar": 1}, target_free="1K")
+
+
+    def test_sized_listing(self):
+        '''
+        Verify sizes are read from a listing of names and sizes.
+        '''
+        test_beginning(self)
+        list_command = "for file in {}*; do echo \"$(basename \"$file\");1000\"; done".format(self.capacity_dir)
+        removed, failed = remove_old_backups(list_command, "test", copies_to_keep=3, delete_command="rm " + self.capacity_dir, max_total_size="3K", sized_listing=True)
+        self.assertEqual(sorted(removed), sorted(('some_backup_12_01_2007.tar.gz', 'some_backup_07_03_2010.zip', 'some_backup_02_15_2012.zip')))
+        self.assertEqual(failed, [])
+
+
+class test_recursive_scan(unittest.TestCase):
+
+    tree_dir = "/tmp/tree_dir_to_fill/"
+    hosts = ("host1", "host2", "host3")
+
+    def setUp(self):
+        for host in self.hosts:
+            for file in file_names:
+                year_dir = "{}{}/{}/".format(self.tree_dir, host, file.split("_")[-1][:4])
+                os.makedirs(year_dir, exist_ok=True)
+                open(year_dir + file, "w").close()
+            open("{}{}/checksums.txt".format(self.tree_dir, host), "w").close()
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {}".format(shlex.quote(self.tree_dir)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def test_scan_tree(self):
+        '''
+        Verify every file below the directory is found with its relative path.
+        '''
+        test_beginning(self)
+        rel_files = scan_tree(self.tree_dir, workers=4)
+        self.assertEqual(len(rel_files), len(self.hosts) * (len(file_names) + 1))
+        self.assertIn("host2/2017/some_backup_03_22_2017.zip", rel_files)
+
+
+    def test_group_backups(self):
+        '''
+        Verify backups are grouped by their leading directories.
+        '''
+        test_beginning(self)
+        rel_files = ["host1/2024/a_01_01_2024.tar", "host1/2023/a_01_01_2023.tar", "host2/2024/a_01_01_2024.tar", "a_01_01_2024.tar"]
+        self.assertEqual(group_backups(rel_files), {"host1": rel_files[:2], "host2": [rel_files[2]], "": [rel_files[3]]})
+        self.assertEqual(set(group_backups(rel_files, group_depth=2)), {"host1/2024", "host1/2023", "host2/2024", ""})
+
+
+    def test_retention_per_group(self):
+        '''
+        Verify the retention policy is applied to each host separately.
+        '''
+        test_beginning(self)
+        removed, failed = remove_old_backups(False, "test", copies_to_keep=copies_to_keep, local_dir=self.tree_dir, recursive=True)
+        self.assertEqual(len(removed), len(self.hosts) * (len(file_names) - copies_to_keep))
+        self.assertEqual(failed, [])
+        for host in self.hosts:
+            remaining = [file for file in scan_tree(self.tree_dir + host) if file != "checksums.txt"]
+            self.assertEqual(len(remaining), copies_to_keep)
+            self.assertTrue(os.path.exists("{}{}/checksums.txt".format(self.tree_dir, host)))
+
+
+class test_date_formats(unittest.TestCase):
+
+    local_dir = "/tmp/date_formats_dir/"
+
+    def setUp(self):
+        os.makedirs(self.local_dir, exist_ok=True)
+
+
+    def tearDown(self):
+        use_date_formats(("mdy",))
+        subprocess.run("rm -r {}".format(shlex.quote(self.local_dir)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def test_each_format(self):
+        '''
+        Verify every registered format parses to the same date once enabled.
+        '''
+        test_beginning(self)
+        use_date_formats(("mdy", "iso", "ymd", "epoch"))
+        expected = date(2024, 5, 1).toordinal()
+        for file in ("db_05_01_2024.tar", "db_2024-05-01T0300.tar", "db-20240501.tar", "db_1714532400.tar"):
+            self.assertEqual(parse_backup_date(file), expected)
+
+
+    def test_disabled_format(self):
+        '''
+        Verify only the enabled formats are recognised.
+        '''
+        test_beginning(self)
+        with self.assertRaises(SystemExit):
+            parse_backup_date("db-20240501.tar")
+        use_date_formats(("ymd",))
+        self.assertIsNone(parse_backup_date("db_05_01_2024.tar", skip_invalid=True))
+
+
+    def test_register_date_format(self):
+        '''
+        Verify a new format can be registered and enabled, and that a pattern without
+        date fields is refused.
+        '''
+        test_beginning(self)
+        register_date_format("dmy", r"(?P<day>\d{2})\.(?P<month>\d{2})\.(?P<year>\d{4})")
+        use_date_formats(("mdy", "dmy"))
+        self.assertEqual(parse_backup_date("db_01.05.2024.tar"), date(2024, 5, 1).toordinal())
+        self.assertEqual(parse_backup_date("db_01_05_2024.tar"), date(2024, 1, 5).toordinal())
+        with self.assertRaises(ValueError):
+            register_date_format("broken", r"\d{8}")
+        del date_formats["dmy"]
+
+
+    def test_skip_invalid(self):
+        '''
+        Verify backups without a date are counted and left alone instead of exiting.
+        '''
+        test_beginning(self)
+        for file in file_names + ("notes.txt", "some_backup_02_30_2023.zip"):
+            open(self.local_dir + file, "w").close()
+        with self.assertRaises(SystemExit):
+            remove_old_backups(False, "test", copies_to_keep=copies_to_keep, local_dir=self.local_dir)
+
+        for file in range(10):
+            open(self.local_dir + "notes_{}.txt".format(file), "w").close()
+        metrics = {"stages": {}}
+        with self.assertLogs("remove_old_backups", level="DEBUG") as logs:
+            removed, failed = prune_backups(False, "test", copies_to_keep=copies_to_keep, local_dir=self.local_dir, skip_invalid=True, metrics=metrics)
+        self.assertEqual(len(removed), len(file_names) - copies_to_keep)
+        self.assertEqual(metrics["stages"]["extract_date"]["skipped"], 12)
+        self.assertEqual(metrics["skipped"], 12)
+        # One warning with the count, and only a few of the skipped backups named.
+        self.assertEqual(len([line for line in logs.output if line.startswith("WARNING")]), 1)
+        self.assertEqual(len([line for line in logs.output if line.startswith("DEBUG") and "Skipped" in line]), skipped_examples)
+        self.assertTrue(os.path.exists(self.local_dir + "notes.txt"))
+        self.assertTrue(os.path.exists(self.local_dir + "some_backup_02_30_2023.zip"))
+
+
+class test_throttled_deletion(unittest.TestCase):
+
+    throttle_dir = "/tmp/throttle_dir_to_fill/"
+
+    def setUp(self):
+        os.makedirs(self.throttle_dir, exist_ok=True)
+        for file in file_names:
+            with open(self.throttle_dir + file, "wb") as backup:
+                backup.truncate(256 * 1024)
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {}".format(shlex.quote(self.throttle_dir)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def test_rate_is_applied(self):
+        '''
+        Verify a large backup is shrunk at about the requested rate before it is removed.
+        '''
+        test_beginning(self)
+        start = time.monotonic()
+        remove_throttled(self.throttle_dir + file_names[0], rate=1024 * 1024, min_size=1)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertFalse(os.path.exists(self.throttle_dir + file_names[0]))
+
+
+    def test_small_and_linked_backups(self):
+        '''
+        Verify backups below the minimum size are removed straight away, and that a
+        backup with another hard link isn't truncated.
+        '''
+        test_beginning(self)
+        start = time.monotonic()
+        remove_throttled(self.throttle_dir + file_names[0], rate=1024, min_size=1024 ** 3)
+        self.assertLess(time.monotonic() - start, 0.2)
+
+        os.link(self.throttle_dir + file_names[1], self.throttle_dir + "linked.tar")
+        remove_throttled(self.throttle_dir + file_names[1], rate=1024, min_size=1)
+        self.assertEqual(os.path.getsize(self.throttle_dir + "linked.tar"), 256 * 1024)
+
+
+    def test_delete_old_backups_throttled(self):
+        '''
+        Verify the serial loop and the worker pool both remove throttled backups.
+        '''
+        test_beginning(self)
+        removed, failed = delete_old_backups(file_names, file_names[:4], "test", local_dir=self.throttle_dir, delete_rate="8M", throttle_size="128K")
+        self.assertEqual(removed, list(file_names[4:]))
+        removed, failed = delete_old_backups(file_names[:4], file_names[:2], "test", local_dir=self.throttle_dir, jobs=2, delete_rate="8M", throttle_size="128K")
+        self.assertEqual(removed, list(file_names[2:4]))
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(os.listdir(self.throttle_dir)), sorted(file_names[:2]))
+
+
+class test_retention_api(unittest.TestCase):
+
+    api_dir = "/tmp/api_dir_to_fill/"
+
+    def setUp(self):
+        os.makedirs(self.api_dir, exist_ok=True)
+        for file in file_names:
+            open(self.api_dir + file, "w").close()
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {}".format(shlex.quote(self.api_dir)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def test_plan(self):
+        '''
+        Verify the plan keeps the newest backups, gives a reason for every entry and
+        can't be changed.
+        '''
+        test_beginning(self)
+        plan = RetentionPlanner(copies_to_keep=copies_to_keep).plan("test", file_names)
+        self.assertEqual([entry.file for entry in plan.keep], ['some_backup_10_01_2022.tar', 'some_backup_03_22_2017.zip', 'some_backup_07_24_2015.zip.7z', 'some_backup_02_15_2012.zip'])
+        self.assertEqual({entry.reason for entry in plan.keep}, {"newest"})
+        self.assertEqual([entry.file for entry in plan.delete], ['some_backup_07_03_2010.zip', 'some_backup_12_01_2007.tar.gz'])
+        self.assertEqual(plan.delete[0].date, date(2010, 7, 3))
+        self.assertEqual(plan.delete[0].reason, "expired")
+        with self.assertRaises(AttributeError):
+            plan.keep = ()
+
+
+    def test_gfs_reasons(self):
+        '''
+        Verify backups kept by a grandfather-father-son tier are labelled with it.
+        '''
+        test_beginning(self)
+        plan = RetentionPlanner(copies_to_keep=3, gfs_policy={"yearly": 5}).plan("test", file_names)
+        reasons = {entry.file: entry.reason for entry in plan.keep}
+        self.assertEqual(reasons['some_backup_10_01_2022.tar'], "newest")
+        self.assertEqual(reasons['some_backup_07_03_2010.zip'], "yearly")
+        self.assertEqual(len(plan.delete), 1)
+
+
+    def test_errors_are_raised(self):
+        '''
+        Verify problems are raised as exceptions instead of exiting.
+        '''
+        test_beginning(self)
+        with self.assertRaises(RetentionError):
+            RetentionPlanner(copies_to_keep=2)
+        for gfs_policy in ({"hourly": 2}, {"monthly": -1}, {"yearly": "5"}):
+            with self.assertRaises(RetentionError):
+                RetentionPlanner(gfs_policy=gfs_policy)
+        with self.assertRaises(InvalidBackupDate):
+            RetentionPlanner().plan("test", file_names + ("notes.txt",))
+        plan = RetentionPlanner(skip_invalid=True).plan("test", file_names + ("notes.txt",))
+        self.assertEqual([entry.file for entry in plan.skipped], ["notes.txt"])
+        with self.assertRaises(MissingBackups):
+            RetentionExecutor(local_dir="/tmp/qwerpiwqer0930402/").execute(plan)
+        with self.assertRaises(RetentionError):
+            RetentionExecutor(local_dir="/tmp/", delete_rate="fast")
+        with self.assertRaises(RetentionError):
+            RetentionExecutor(local_dir="/tmp/", throttle_size="10%")
+        with self.assertRaises(RetentionError):
+            RetentionExecutor(local_dir="/tmp/", jobs=0)
+
+
+    def test_planner_date_formats(self):
+        '''
+        Verify each planner parses dates with its own formats, whatever formats are
+        enabled for the module.
+        '''
+        test_beginning(self)
+        use_date_formats(("ymd",))
+        try:
+            plan = RetentionPlanner(copies_to_keep=3, date_formats=("iso", "mdy")).plan("test", file_names + ("db-2030-01-01.tar",))
+            self.assertEqual(plan.keep[0].file, "db-2030-01-01.tar")
+            self.assertEqual(len(plan.delete), 4)
+            with self.assertRaises(InvalidBackupDate):
+                RetentionPlanner().plan("test", ("db-2030-01-01.tar",))
+            with self.assertRaises(RetentionError):
+                RetentionPlanner(date_formats=("dmy_unknown",))
+        finally:
+            use_date_formats(("mdy",))
+
+
+    def test_execute_plan(self):
+        '''
+        Verify the executor removes the backups marked for deletion and nothing else.
+        '''
+        test_beginning(self)
+        plan = RetentionPlanner(copies_to_keep=copies_to_keep).plan("test", os.listdir(self.api_dir))
+        removed, failed = RetentionExecutor(local_dir=self.api_dir, jobs=2).execute(plan)
+        self.assertEqual(removed, [entry.file for entry in plan.delete])
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(os.listdir(self.api_dir)), sorted(entry.file for entry in plan.keep))
+
+
+class test_list_file(unittest.TestCase):
+
+    list_dir = "/tmp/list_file_dir/"
+
+    def setUp(self):
+        os.makedirs(self.list_dir, exist_ok=True)
+        for file in file_names:
+            open(self.list_dir + file, "w").close()
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {}".format(shlex.quote(self.list_dir)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def test_read_newline_and_csv(self):
+        '''
+        Verify backups are read from newline separated and CSV inventories, including
+        quoted names and a missing final newline.
+        '''
+        test_beginning(self)
+        with open(self.list_dir + "inventory.txt", "w") as inventory:
+            inventory.write("a_01_01_2024.tar\r\n\nb c_01_02_2024.tar")
+        self.assertEqual(list(read_list_file(self.list_dir + "inventory.txt")), ["a_01_01_2024.tar", "b c_01_02_2024.tar"])
+
+        with open(self.list_dir + "inventory.csv", "w") as inventory:
+            inventory.write('"bucket","a_01_01_2024.tar","10"\n"bucket","b, c_01_02_2024.tar","20"\n')
+        self.assertEqual(list(read_list_file(self.list_dir + "inventory.csv", column=1)), ["a_01_01_2024.tar", "b, c_01_02_2024.tar"])
+
+        open(self.list_dir + "empty.txt", "w").close()
+        self.assertEqual(list(read_list_file(self.list_dir + "empty.txt")), [])
+
+
+    def test_unreadable_list_file(self):
+        '''
+        Verify a missing list file or a column past the end of each row ends the run
+        with an error instead of finding no backups.
+        '''
+        test_beginning(self)
+        with self.assertRaises(SystemExit):
+            list(read_list_file(self.list_dir + "missing.txt"))
+        with open(self.list_dir + "inventory.csv", "w") as inventory:
+            inventory.write('"bucket","a_01_01_2024.tar","10"\n')
+        with self.assertRaises(SystemExit):
+            list(read_list_file(self.list_dir + "inventory.csv", column=3))
+        with self.assertRaises(SystemExit):
+            remove_old_backups(False, "test", copies_to_keep=copies_to_keep, list_file=self.list_dir + "missing.txt", stream=True)
+
+
+    def test_remove_old_backups_from_list_file(self):
+        '''
+        Verify a list file replaces the list command, with and without streaming.
+        '''
+        test_beginning(self)
+        with open(self.list_dir + "inventory.txt", "w") as inventory:
+            inventory.write("".join(file + "\n" for file in file_names))
+        removed, failed = remove_old_backups(False, "test", copies_to_keep=copies_to_keep, local_dir=self.list_dir, list_file=self.list_dir + "inventory.txt", dry_run=True)
+        self.assertEqual(failed, [])
+        removed, failed = remove_old_backups(False, "test", copies_to_keep=copies_to_keep, local_dir=self.list_dir, list_file=self.list_dir + "inventory.txt", stream=True)
+        self.assertEqual(sorted(removed), sorted(['some_backup_07_03_2010.zip', 'some_backup_12_01_2007.tar.gz']))
+
+
+    def test_flat_memory(self):
+        '''
+        Verify streaming from a large inventory holds only the retention window in memory.
+        '''
+        test_beginning(self)
+        with open(self.list_dir + "inventory.txt", "w") as inventory:
+            for index in range(200000):
+                inventory.write("some_backup_{}_{:02d}_{:02d}_{}.tar\n".format(index, index % 12 + 1, index % 28 + 1, 2000 + index // 336 % 20))
+        tracemalloc.start()
+        old_backups = sum(1 for file in window_old_backups(read_list_file(self.list_dir + "inventory.txt"), copies_to_keep))
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.assertGreater(old_backups, 199000)
+        self.assertLess(peak, os.path.getsize(self.list_dir + "inventory.txt") // 4)
+
+
+# A stand-in for a long-lived delete helper. It answers requests in groups of the size
+# given as its first argument, so a group larger than one only completes when several
+# requests are sent ahead of their answers. Backups with "locked" in their name fail,
+# and a backup with "crash" in its name makes the helper exit without answering.
+fake_delete_helper = """
+import os
+import sys
+
+group = int(sys.argv[1])
+with open(sys.argv[2] + "starts.log", "a") as starts:
+    starts.write("started\\n")
+
+pending = []
+def answer():
+    for path in pending:
+        if "locked" in path:
+            print("ERR permission denied")
+        else:
+            os.remove(path)
+            print("OK")
+    pending.clear()
+    sys.stdout.flush()
+
+for line in iter(sys.stdin.readline, ""):
+    if "crash" in line:
+        sys.exit(1)
+    pending.append(line.rstrip("\\n"))
+    if len(pending) >= group:
+        answer()
+answer()
+"""
+
+
+class test_coprocess_deletion(unittest.TestCase):
+
+    helper_dir = "/tmp/helper_dir_to_fill/"
+    fake_helper = "/tmp/fake_delete_helper.py"
+
+    def setUp(self):
+        os.makedirs(self.helper_dir, exist_ok=True)
+        for file in file_names:
+            open(self.helper_dir + file, "w").close()
+
+        with open(self.fake_helper, "w") as script:
+            script.write(fake_delete_helper)
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {} {}".format(shlex.quote(self.helper_dir), shlex.quote(self.fake_helper)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def helper_command(self, group):
+        return "{} {} {} {}".format(sys.executable, self.fake_helper, group, self.helper_dir)
+
+
+    def test_single_helper_pipelined(self):
+        '''
+        Verify every old backup is removed by one helper with several requests in flight.
+        '''
+        test_beginning(self)
+        files_to_keep = file_names[:2]
+        removed, failed = delete_old_backups(file_names, files_to_keep, "test", local_dir=self.helper_dir, delete_command=self.helper_command(2), batch_mode="coprocess", jobs=2)
+        self.assertEqual(removed, list(file_names[2:]))
+        self.assertEqual(failed, [])
+        with open(self.helper_dir + "starts.log") as starts:
+            self.assertEqual(len(starts.readlines()), 1)
+        self.assertEqual(sorted(os.listdir(self.helper_dir)), sorted(files_to_keep + ("starts.log",)))
+
+
+    def test_helper_failures(self):
+        '''
+        Verify refused backups and backups the helper never answered are reported as failed.
+        '''
+        test_beginning(self)
+        rel_files = ("some_backup_locked_01_01_2001.zip",) + file_names[:2] + ("some_backup_crash_01_01_2002.zip",) + file_names[2:]
+        removed, failed = delete_old_backups(rel_files, (), "test", local_dir=self.helper_dir, delete_command=self.helper_command(1), batch_mode="coprocess", jobs=1)
+        self.assertEqual(removed, list(file_names[:2]))
+        self.assertEqual(failed, ["some_backup_locked_01_01_2001.zip", "some_backup_crash_01_01_2002.zip"] + list(file_names[2:]))
+
+
+# A stand-in for a rate limited remote. Each run registers itself in the active
+# directory, and if more runs than the limit given as its first argument are active it
+# fails as throttled. Backups with "locked" in their name always fail.
+fake_rate_limited_command = """
+import os
+import sys
+import time
+
+limit, state_dir, path = int(sys.argv[1]), sys.argv[2], sys.argv[3]
+slot = os.path.join(state_dir, "active", str(os.getpid()))
+open(slot, "w").close()
+try:
+    if len(os.listdir(os.path.join(state_dir, "active"))) > limit:
+        with open(os.path.join(state_dir, "throttled.log"), "a") as throttled:
+            throttled.write(path + "\\n")
+        sys.exit(1)
+    time.sleep(0.05)
+    if "locked" in path:
+        sys.exit(1)
+    os.remove(path)
+finally:
+    os.remove(slot)
+"""
+
+
+class test_async_deletion(unittest.TestCase):
+
+    async_dir = "/tmp/async_dir_to_fill/"
+    state_dir = "/tmp/async_state/"
+    fake_command = "/tmp/fake_rate_limited.py"
+
+    def setUp(self):
+        os.makedirs(self.async_dir, exist_ok=True)
+        os.makedirs(self.state_dir + "active", exist_ok=True)
+        self.backups = ["some_backup_{}_01_01_2000.tar".format(index) for index in range(24)]
+        for file in self.backups:
+            open(self.async_dir + file, "w").close()
+
+        with open(self.fake_command, "w") as script:
+            script.write(fake_rate_limited_command)
+
+
+    def tearDown(self):
+        subprocess.run("rm -r {} {} {}".format(shlex.quote(self.async_dir), shlex.quote(self.state_dir), shlex.quote(self.fake_command)), shell=True, capture_output=True)
+        logging.info("\n")
+
+
+    def delete_command(self, limit):
+        return "{} {} {} {} ".format(sys.executable, self.fake_command, limit, self.state_dir)
+
+
+    def test_adaptive_limit(self):
+        '''
+        Verify the limit grows additively, halves on failure at most once per deletion
+        time and never passes its bounds.
+        '''
+        test_beginning(self)
+        limit = AdaptiveLimit(4)
+        for attempt in range(50):
+            limit.succeeded(0.1)
+        self.assertEqual(limit.current(), 4)
+        limit.failed()
+        self.assertEqual(limit.current(), 2)
+        limit.failed()
+        self.assertEqual(limit.current(), 2)
+        limit.last_decrease = 0
+        limit.succeeded(1.0)
+        self.assertEqual(limit.current(), 1)
+        limit.last_decrease = 0
+        limit.failed()
+        self.assertEqual(limit.current(), 1)
+
+
+    def test_rate_limited_remote(self):
+        '''
+        Verify every backup is removed from a remote that throttles too many deletions
+        at once, by backing off and retrying.
+        '''
+        test_beginning(self)
+        removed, failed = run_async_delete(self.backups, "test", self.delete_command(3), local_dir=self.async_dir, max_concurrency=8, retries=8, backoff=0.01)
+        self.assertEqual(sorted(removed), sorted(self.backups))
+        self.assertEqual(failed, [])
+        self.assertEqual(os.listdir(self.async_dir), [])
+
+
+    def test_permanent_failure(self):
+        '''
+        Verify a backup that can't be removed is reported once its retries are used up.
+        '''
+        test_beginning(self)
+        locked_file = "some_backup_locked_01_01_2001.zip"
+        open(self.async_dir + locked_file, "w").close()
+        removed, failed = run_async_delete(self.backups[:4] + [locked_file], "test", self.delete_command(8), local_dir=self.async_dir, max_concurrency=4, retries=2, backoff=0.01)
+        self.assertEqual(sorted(removed), sorted(self.backups[:4]))
+        self.assertEqual(failed, [locked_file])
+
+
+    def test_spawn_failure_is_retried(self):
+        '''
+        Verify a delete command that can't be started, as when too many files are open,
+        is retried instead of ending every deletion.
+        '''
+        test_beginning(self)
+        create_subprocess_shell = asyncio.create_subprocess_shell
+        spawn_failures = [OSError(24, "Too many open files")] * 3
+
+        async def flaky_create_subprocess_shell(*args, **kwargs):
+            if spawn_failures:
+                raise spawn_failures.pop()
+            return await create_subprocess_shell(*args, **kwargs)
+
+        asyncio.create_subprocess_shell = flaky_create_subprocess_shell
+        try:
+            removed, failed = run_async_delete(self.backups[:4], "test", "rm ", local_dir=self.async_dir, max_concurrency=4, retries=4, backoff=0.01)
+        finally:
+            asyncio.create_subprocess_shell = create_subprocess_shell
+        self.assertEqual(sorted(removed), sorted(self.backups[:4]))
+        self.assertEqual(failed, [])
+
+
+    def test_slow_listing_doesnt_stall_deletions(self):
+        '''
+        Verify deletions finish while the listing is waiting for its next line, and a
+        listing error lets the deletions already started finish before it is raised.
+        '''
+        test_beginning(self)
+        removed_while_listing = []
+
+        def slow_listing():
+            yield self.backups[0]
+            time.sleep(1)
+            removed_while_listing.append(not os.path.exists(self.async_dir + self.backups[0]))
+            yield self.backups[1]
+            raise RuntimeError("listing broke")
+
+        # The first attempt fails, so the backup is only removed during the pause in the
+        # listing if the deletion can be reaped and retried meanwhile.
+        retry_then_remove = "f() {{ if [ -e {0}tried ]; then rm \"$1\"; else touch {0}tried; exit 1; fi; }}; f ".format(self.state_dir)
+        with self.assertRaises(RuntimeError):
+            run_async_delete(slow_listing(), "test", retry_then_remove, local_dir=self.async_dir, max_concurrency=4, backoff=0.01)
+        self.assertEqual(removed_while_listing, [True])
+        self.assertEqual(len(os.listdir(self.async_dir)), len(self.backups) - 2)
+
+
+    def test_delete_old_backups_async(self):
+        '''
+        Verify the async mode is used by delete_old_backups.
+        '''
+        test_beginning(self)
+        removed, failed = delete_old_backups(self.backups, self.backups[:4], "test", local_dir=self.async_dir, delete_command=self.delete_command(8), batch_mode="async", jobs=4)
+        self.assertEqual(sorted(removed), sorted(self.backups[4:]))
+        self.assertEqual(sorted(os.listdir(self.async_dir)), sorted(self.backups[:4]))
+
+
 if __name__ == '__main__':
     logging.basicConfig(filename="test.log",format="%(asctime)s:%(levelname)s:%(message)s", level=logging.DEBUG)
     logging.info('')